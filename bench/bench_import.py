@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MODULES = ('mbread', 'mbbatch', 'mbvolc', 'mbcorr', 'mblipid', 'mbdecomp',
+           'mbstudy')
+HEAVY = ('matplotlib', 'seaborn', 'scipy')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# timed in a fresh interpreter each run, as a short-lived batch worker would
+SNIPPET = '''
+import sys, time
+t = time.perf_counter()
+import {module}
+t = time.perf_counter() - t
+heavy = [m for m in {heavy!r} if m in sys.modules]
+print(t, ','.join(heavy))
+'''
+
+
+def time_import(module, repeat=5):
+
+    code = SNIPPET.format(module=module, heavy=HEAVY)
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code],
+                             env=env,
+                             check=True,
+                             capture_output=True,
+                             text=True).stdout.split()
+        times.append(float(out[0]))
+    return {
+        'module': module,
+        'median_s': statistics.median(times),
+        'min_s': min(times),
+        'heavy': out[1].split(',') if len(out) > 1 else []
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='cold import time of the metakit modules')
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = [time_import(module, args.repeat) for module in args.modules]
+    for res in results:
+        print(f"{res['module']:<10} {res['median_s'] * 1e3:8.1f} ms  "
+              f"heavy: {', '.join(res['heavy']) or '-'}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from gen_study import ROOT, gen_study
+
+from mbcorr import get_diff_chem, get_diff_corr
+from mbdecomp import sort_oplsda
+from mblipid import join_lipids
+from mbread import add_label_row, clear_cache, get_rsd, read_file
+from mbvolc import (check_volc_kegg2, clear_kegg_cache, count_vol,
+                    list_volc_sig2)
+
+
+def _kegg_lists(obj_names):
+    return (1, obj_names, check_volc_kegg2(1, obj_names))
+
+
+def _diff_corr(obj_names):
+    return (get_diff_corr(1, obj_names, n=200), )
+
+
+# name -> (function, setup); setup(obj_names) returns the call arguments
+# and runs untimed, so each case measures one public function
+CASES = {
+    'read_file': (read_file, lambda obj_names: (1, 'neg')),
+    'get_rsd': (get_rsd, lambda obj_names: (1, 'neg')),
+    'add_label_row': (add_label_row, lambda obj_names:
+                      (1, obj_names[0][0], ['Ar', 'A'], 6)),
+    'count_vol': (count_vol, lambda obj_names: (obj_names, )),
+    'list_volc_sig2': (list_volc_sig2, lambda obj_names: (obj_names, )),
+    'check_volc_kegg2': (check_volc_kegg2, lambda obj_names: (1, obj_names)),
+    'get_diff_chem': (get_diff_chem, _diff_corr),
+    'join_lipids': (join_lipids, lambda obj_names: (obj_names, obj_names)),
+    'sort_oplsda': (sort_oplsda, _kegg_lists),
+}
+
+
+def _cold():
+    # cold in-process caches and no persisted KEGG indexes; the OS page
+    # cache stays warm
+    clear_cache()
+    clear_kegg_cache(persisted=True)
+
+
+def _time(func, args):
+
+    t = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - t
+
+
+def _run_case(func, args, repeat):
+
+    times = []
+    for _ in range(repeat):
+        _cold()
+        times.append(_time(func, args))
+
+    _cold()
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # the same calls again with every cache primed by the runs above
+    warm = [_time(func, args) for _ in range(repeat)]
+
+    return {
+        'median_s': statistics.median(times),
+        'min_s': min(times),
+        'warm_median_s': statistics.median(warm),
+        'peak_mib': peak / 2**20
+    }
+
+
+def _git_commit():
+
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=ROOT,
+                              check=True,
+                              capture_output=True,
+                              text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(sizes=(1000, 10000, 50000),
+              cases=tuple(CASES),
+              n_projects=2,
+              repeat=3,
+              workdir=None):
+
+    results = []
+    cwd = os.getcwd()
+    for n_features in sizes:
+        with tempfile.TemporaryDirectory(dir=workdir) as root:
+            obj_names = gen_study(root, n_features, n_projects=n_projects)
+            os.chdir(root)
+            try:
+                for name in cases:
+                    func, setup = CASES[name]
+                    res = _run_case(func, setup(obj_names), repeat)
+                    res.update(case=name, n_features=n_features)
+                    results.append(res)
+                    print(
+                        f'{name:<18} {n_features:>6} '
+                        f'{res["median_s"] * 1e3:10.1f} ms '
+                        f'{res["warm_median_s"] * 1e3:10.1f} ms warm '
+                        f'{res["peak_mib"]:8.1f} MiB',
+                        flush=True)
+            finally:
+                os.chdir(cwd)
+
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'n_projects': n_projects,
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def compare(old, new):
+    # ratios above 1 are slowdowns
+    key = ['case', 'n_features']
+    old = pd.DataFrame(old['results']).set_index(key)
+    new = pd.DataFrame(new['results']).set_index(key)
+    both = old.join(new, lsuffix='_old', rsuffix='_new', how='inner')
+    both['time_ratio'] = both['median_s_new'] / both['median_s_old']
+    both['mem_ratio'] = both['peak_mib_new'] / both['peak_mib_old']
+    return both[['median_s_old', 'median_s_new', 'time_ratio', 'mem_ratio']]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='time and memory-profile the public mb* functions')
+    parser.add_argument('--sizes',
+                        type=int,
+                        nargs='+',
+                        default=[1000, 10000, 50000])
+    parser.add_argument('--cases', nargs='+', default=list(CASES))
+    parser.add_argument('--projects', type=int, default=2)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workdir', help='where the study trees are written')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='an earlier --json result')
+    args = parser.parse_args()
+
+    report = run_suite(args.sizes, args.cases, args.projects, args.repeat,
+                       args.workdir)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mbread import unicodify  # noqa: E402
+
+# the mis-decoded Greek prefixes found in real deliveries
+GARBLED = ('伪', '¦Â', '尾', '¦´', '螖', '¦¤', '未', '¦Ä', '卤', '¡À', '')
+
+PATHWAYS = [f'map{i:05d} Pathway {i}' for i in range(10, 130)] + [
+    'map01100 Metabolic pathways',
+    'map01110 Biosynthesis of secondary metabolites',
+    'map01120 Microbial metabolism in diverse environments'
+]
+
+LIPIDS = {
+    'FA': ('Fatty acids', 'Eicosanoids', 'Fatty esters'),
+    'GL': ('Diradylglycerols', 'Triradylglycerols'),
+    'GP': ('Glycerophosphocholines', 'Glycerophosphoethanolamines'),
+    'SP': ('Ceramides', 'Sphingoid bases'),
+}
+
+
+def obj_names_for(n_projects):
+    return [f'{g}-vs-{g}r' for g in 'ABCDEFGHIJKLMNOP'[:n_projects]]
+
+
+def _kegg_maps(rng, n_features):
+
+    n_maps = rng.integers(1, 5, n_features)
+    maps = np.full(n_features, np.nan, dtype=object)
+    for i in np.flatnonzero(rng.random(n_features) > 0.3):
+        picks = rng.choice(len(PATHWAYS), n_maps[i], replace=False)
+        maps[i] = ';'.join(PATHWAYS[j] for j in picks)
+    return maps
+
+
+def _lipid_classes(rng, n_features):
+
+    cats = np.array(list(LIPIDS))[rng.integers(0, len(LIPIDS), n_features)]
+    mains = np.array([rng.choice(LIPIDS[cat]) for cat in cats])
+    subs = np.char.add(mains.astype(str),
+                       rng.choice([' [1]', ' [2]'], n_features))
+    return cats, mains, subs
+
+
+def _write_project(root, ind, obj, n_features, n_samples, n_qc, rng):
+
+    group = obj[0]
+    result = os.path.join(root, f'Result-{ind}')
+    quant = os.path.join(result, '1.MetQuant')
+    kegg = os.path.join(result, '2.MetAnnotation', 'KEGG')
+    lipid = os.path.join(result, '2.MetAnnotation', 'Lipidmaps')
+    for path in (quant, kegg, lipid):
+        os.makedirs(path, exist_ok=True)
+
+    for met in ('neg', 'pos'):
+        prefix = np.array(GARBLED)[np.arange(n_features) % len(GARBLED)]
+        suffix = [f'-M{met}{i}' for i in range(n_features)]
+        names = pd.Index(np.char.add(prefix.astype(str), suffix), name='Name')
+        ids = pd.Index([f'Com_{i}_{met}' for i in range(n_features)],
+                       name='ID')
+
+        base = rng.lognormal(10, 1.5, n_features)
+        fc = rng.lognormal(0, 1.2, n_features)
+        quant_df = pd.DataFrame({'Name': names}, index=ids)
+        quant_df['Formula'] = 'C6H12O6'
+        drift = rng.normal(1, 0.15, (n_features, n_qc))
+        for i in range(n_qc):
+            quant_df[f'{met}_QC{i + 1}'] = base * drift[:, i]
+        for i in range(n_samples):
+            quant_df[f'{met}_{group}r{i + 1}'] = base * rng.normal(
+                1, 0.2, n_features)
+        for i in range(n_samples):
+            quant_df[f'{met}_{group}{i + 1}'] = base * fc * rng.normal(
+                1, 0.2, n_features)
+        quant_df.to_csv(os.path.join(quant, f'meta_intensity_{met}.xls'),
+                        sep='\t')
+
+        kegg_df = pd.DataFrame({'Name': names}, index=ids)
+        kegg_df['Kegg_map'] = _kegg_maps(rng, n_features)
+        kegg_df.to_csv(os.path.join(kegg, f'meta_{met}_kegg_anno.xls'),
+                       sep='\t')
+
+        lipid_df = pd.DataFrame({'Name': names}, index=ids)
+        (lipid_df['CATEGORY'], lipid_df['MAIN_CLASS'],
+         lipid_df['SUB_CLASS']) = _lipid_classes(rng, n_features)
+        lipid_df.to_csv(os.path.join(lipid, f'meta_{met}_lipidmaps_anno.xls'),
+                        sep='\t')
+
+        pval = rng.uniform(0, 1, n_features)**3
+        volc_df = pd.DataFrame({'FC': fc}, index=names)
+        volc_df['log2(FC)'] = np.log2(fc)
+        volc_df['raw.pval'] = pval
+        volc_df['-log10(p)'] = -np.log10(pval)
+        volc_df.index.name = None
+        volc_df.to_csv(os.path.join(result, f'volcano-{met}.csv'))
+
+        vip = pd.DataFrame({'V1': rng.gamma(2, 0.5, n_features)}, index=names)
+        vip.index.name = None
+        vip.to_csv(os.path.join(result, f'oplsda_vip-{met}.csv'))
+
+        model = pd.DataFrame(
+            {
+                'R2X(cum)': rng.uniform(0.3, 0.7, 3),
+                'R2Y(cum)': rng.uniform(0.8, 1, 3),
+                'Q2(cum)': rng.uniform(0.5, 0.9, 3)
+            },
+            index=['p1', 'o1', 'o2'])
+        model.to_csv(os.path.join(result, f'oplsda_model-{met}.csv'))
+
+        # the samples x metabolites table that read_upload_df serves to
+        # get_corr, with names already unicodified; only the negative mode
+        # is uploaded
+        if met == 'neg':
+            upload = unicodify(quant_df).set_index('Name')
+            upload = upload.filter(regex=f'^neg_{group}')
+            upload.T.to_csv(os.path.join(result, f'{group}-neg.csv'))
+
+
+def gen_study(root,
+              n_features=1000,
+              n_samples=6,
+              n_projects=2,
+              n_qc=5,
+              seed=0):
+
+    rng = np.random.default_rng(seed)
+    obj_names = obj_names_for(n_projects)
+    for ind, obj in enumerate(obj_names, start=1):
+        _write_project(root, ind, obj, n_features, n_samples, n_qc, rng)
+    return obj_names
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='write a synthetic Result-N study tree')
+    parser.add_argument('root')
+    parser.add_argument('--features', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=6)
+    parser.add_argument('--projects', type=int, default=2)
+    parser.add_argument('--qc', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    obj_names = gen_study(args.root, args.features, args.samples,
+                          args.projects, args.qc, args.seed)
+    print(' '.join(obj_names))
+
+
+if __name__ == '__main__':
+    main()
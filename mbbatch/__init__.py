@@ -0,0 +1 @@
+from mbbatch.mbbatch import add_result_hook, run_batch, run_projects
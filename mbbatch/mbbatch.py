@@ -0,0 +1,54 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def _workers(workers):
+    if workers is not None and workers < 0:
+        return os.cpu_count()
+    return workers
+
+
+# applied to every result that comes back from a worker process
+_result_hooks = []
+
+
+def add_result_hook(hook):
+    if hook not in _result_hooks:
+        _result_hooks.append(hook)
+
+
+def run_batch(func, tasks, workers=None, kind='process'):
+
+    tasks = list(tasks)
+    workers = _workers(workers)
+    if not workers or workers == 1 or len(tasks) < 2:
+        return [func(*task) for task in tasks]
+
+    pool = ProcessPoolExecutor if kind == 'process' else ThreadPoolExecutor
+    with pool(max_workers=min(workers, len(tasks))) as ex:
+        # Executor.map yields in submission order, so merges stay
+        # deterministic whatever finishes first
+        results = list(ex.map(func, *zip(*tasks)))
+    if kind == 'process':
+        for hook in _result_hooks:
+            results = [hook(res) for res in results]
+    return results
+
+
+def _call_project(func, ind, met, kwargs):
+    return func(ind, met=met, **kwargs)
+
+
+def run_projects(func,
+                 obj_names,
+                 mets=('neg', 'pos'),
+                 workers=None,
+                 kind='process',
+                 **kwargs):
+
+    tasks = [(func, ind, met, kwargs) for met in mets
+             for ind, _ in enumerate(obj_names, start=1)]
+    results = run_batch(_call_project, tasks, workers=workers, kind=kind)
+
+    n = len(obj_names)
+    return {met: results[i * n:(i + 1) * n] for i, met in enumerate(mets)}
@@ -1,2 +1,3 @@
-from mbcorr.mbcorr import (get_corr, get_diff_chem, get_diff_corr,
-                           get_diff_corr_all, plot_diff_chem)
+from mbcorr.mbcorr import (corr_blocks, corr_edges, corr_matrix, get_corr,
+                           get_diff_chem, get_diff_corr, get_diff_corr_all,
+                           get_diff_edges, plot_diff_chem)
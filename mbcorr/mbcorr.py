@@ -1,46 +1,68 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import seaborn as sns
 
-from mbread import read_upload_df
-from mbvolc import list_volc_sig
+from mbprof import instrument
+from mbread import (design_groups, mode_columns, paired_columns, read_design,
+                    read_upload_df)
+from mbvolc import load_volc, volc_sig
 
 
-def get_corr(ind, obj_names, fcthr=2, pthr=0.05, direc='up', met='neg'):
+def get_corr(ind,
+             obj_names,
+             fcthr=2,
+             pthr=0.05,
+             direc='up',
+             met='neg',
+             volc_list=None):
 
-    volc_list = list_volc_sig(obj_names,
-                              fcthr=fcthr,
-                              pthr=pthr,
-                              direc=direc,
-                              met=met)
-    obj = obj_names[ind - 1]
-    obj_list = volc_list[obj].dropna().tolist()
-    obj_df = read_upload_df(ind=ind, obj=obj[0])
+    obj = obj_names[int(ind) - 1]
+    if volc_list is None:
+        sig = volc_sig(load_volc(ind, met), fcthr=fcthr, pthr=pthr)
+        obj_list = sig[direc if direc in ('up', 'down') else 'all'].tolist()
+    else:
+        obj_list = volc_list[obj].dropna().tolist()
+    obj_df = read_upload_df(ind=ind, obj=obj[0], met=met)
     return obj_df[obj_list].T
 
 
 def get_diff_corr(ind,
                   obj_names,
                   n=10,
-                  n_sample=6,
+                  n_sample=None,
                   fcthr=2,
                   pthr=0.05,
                   direc='up',
-                  met='neg'):
-
-    corr = get_corr(ind,
-                    obj_names,
-                    fcthr=fcthr,
-                    pthr=pthr,
-                    direc=direc,
-                    met=met)
-    obj_name = obj_names[ind - 1][0]
-
-    corr1 = corr.T.iloc[:n_sample, :].values
-    corr2 = corr.T.iloc[n_sample:, :].values
+                  met='neg',
+                  volc_list=None,
+                  corr=None,
+                  design=None):
+
+    if corr is None:
+        corr = get_corr(ind,
+                        obj_names,
+                        fcthr=fcthr,
+                        pthr=pthr,
+                        direc=direc,
+                        met=met,
+                        volc_list=volc_list)
+    obj_name = obj_names[int(ind) - 1][0]
+
+    if n_sample is None:
+        # ref and case samples matched on the pair id of the design; the
+        # uploaded table may carry them without the mode prefix
+        design = read_design(ind, met, design)
+        ref, case = paired_columns(design, *design_groups(design, obj_name))
+        samples = pd.Series(corr.columns,
+                            index=mode_columns(corr.columns, met))
+        corr1 = corr[samples[ref]].T.values
+        corr2 = corr[samples[case]].T.values
+        labels = [col[len(met) + 1:] for col in case]
+    else:
+        corr1 = corr.T.iloc[:n_sample, :].values
+        corr2 = corr.T.iloc[n_sample:, :].values
+        labels = [f'{obj_name}{i}' for i in range(1, n_sample + 1)]
     Δcorr = pd.DataFrame(corr1 - corr2, columns=corr.T.columns)
-    Δcorr.index = [f"Δ{obj_name}{i}" for i in range(1, n_sample + 1)]
+    Δcorr.index = [f"Δ{label}" for label in labels]
 
     Δcorr = Δcorr.T
     Δcorr['total'] = Δcorr.sum(axis=1)
@@ -52,7 +74,7 @@ def get_diff_corr(ind,
     return Δcorr.head(n)
 
 
-def get_diff_corr_all(ind, obj_names, fcthr, pthr, met, n=10, n_sample=6):
+def get_diff_corr_all(ind, obj_names, fcthr, pthr, met, n=10, n_sample=None):
 
     diff1 = get_diff_corr(
         ind,
@@ -73,14 +95,86 @@ def get_diff_corr_all(ind, obj_names, fcthr, pthr, met, n=10, n_sample=6):
                           pthr=pthr,
                           met=met,
                           direc='down')
-    return diff1.append(diff2)
+    return pd.concat([diff1, diff2])
+
+
+def _corr_scores(df, method='pearson'):
+    # columns scaled to zero mean and unit norm, so a block of Pearson
+    # correlations is a single float32 matrix product
+    if method == 'spearman':
+        df = df.rank()
+    elif method != 'pearson':
+        raise ValueError(f'unknown correlation method: {method}')
+    z = df.to_numpy(dtype='float32')
+    z = z - z.mean(axis=0)
+    z /= np.linalg.norm(z, axis=0)
+    return z
+
+
+def corr_blocks(df, method='pearson', block=1024):
+
+    z = _corr_scores(df, method)
+    for start in range(0, z.shape[1], block):
+        yield start, np.clip(z[:, start:start + block].T @ z, -1, 1)
+
+
+def corr_matrix(df, method='pearson', block=1024):
+
+    corr = np.empty((df.shape[1], df.shape[1]), dtype='float32')
+    for start, rows in corr_blocks(df, method=method, block=block):
+        corr[start:start + len(rows)] = rows
+    return pd.DataFrame(corr, index=df.columns, columns=df.columns)
+
+
+def corr_edges(df, method='pearson', top_k=None, threshold=None, block=1024):
 
+    sources, targets, values = [], [], []
 
-def get_diff_chem(diff_corr, n_reduced=40):
+    for start, rows in corr_blocks(df, method=method, block=block):
+        # score only the upper triangle; -1 marks pairs that are dropped
+        upper = np.arange(
+            rows.shape[1]) > start + np.arange(len(rows))[:, None]
+        score = np.where(upper, np.abs(rows), -1).ravel()
+        if threshold is not None:
+            score[score <= threshold] = -1
+        if top_k is not None and top_k < len(score):
+            keep = np.argpartition(-score, top_k)[:top_k]
+        else:
+            keep = np.arange(len(score))
+        keep = keep[score[keep] >= 0]
+        i, j = np.unravel_index(keep, rows.shape)
+        sources.append(i + start)
+        targets.append(j)
+        values.append(rows[i, j])
+
+    i, j, r = (np.concatenate(a) for a in (sources, targets, values))
+    order = np.argsort(-np.abs(r), kind='stable')[:top_k]
+    return pd.DataFrame({
+        'source': df.columns[i[order]],
+        'target': df.columns[j[order]],
+        'r': r[order],
+    })
+
+
+def _reduce_chem(diff_corr, n_reduced):
 
     name_len = [len(i) for i in diff_corr.index]
     to_reduce = diff_corr.index[np.array(name_len) > n_reduced]
-    diff_corr_t = diff_corr.T.drop(to_reduce, axis=1)
+    return diff_corr.T.drop(to_reduce, axis=1)
+
+
+def get_diff_chem(diff_corr, n_reduced=40, backend='pandas', block=1024):
+
+    diff_corr_t = _reduce_chem(diff_corr, n_reduced)
+
+    if backend == 'blocked':
+        corr_chem = corr_matrix(diff_corr_t, block=block)
+        # the matrix is symmetric, so row and column totals agree and one
+        # reindex replaces the two sort/transpose passes
+        total = corr_chem.to_numpy().sum(axis=1)
+        rows = np.argsort(total, kind='stable')
+        cols = np.argsort(-total, kind='stable')
+        return corr_chem.iloc[rows, cols]
 
     corr_chem = diff_corr_t.corr()
     corr_chem['total'] = corr_chem.sum(axis=1)
@@ -93,6 +187,21 @@ def get_diff_chem(diff_corr, n_reduced=40):
     return corr_chem_t
 
 
+def get_diff_edges(diff_corr,
+                   n_reduced=40,
+                   method='pearson',
+                   top_k=None,
+                   threshold=None,
+                   block=1024):
+
+    diff_corr_t = _reduce_chem(diff_corr, n_reduced)
+    return corr_edges(diff_corr_t,
+                      method=method,
+                      top_k=top_k,
+                      threshold=threshold,
+                      block=block)
+
+
 def plot_diff_chem(ax,
                    corr,
                    cmap='RdBu_r',
@@ -104,6 +213,8 @@ def plot_diff_chem(ax,
                    mask=True,
                    xangle=45,
                    yangle=0):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
 
     if mask:
         mask = np.zeros_like(corr)
@@ -136,3 +247,6 @@ def plot_diff_chem(ax,
              rotation=yangle,
              fontsize=fontsize,
              horizontalalignment='right')
+
+
+instrument(__name__)
@@ -1 +1,2 @@
-from mbdecomp.mbdecomp import plot_oplsda_model, plot_vip, sort_oplsda
+from mbdecomp.mbdecomp import (fit_oplsda, perm_oplsda, plot_oplsda_model,
+                               plot_vip, sort_oplsda)
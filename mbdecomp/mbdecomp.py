@@ -1,26 +1,213 @@
-import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 
-from mbread import read_oplsda, read_oplsda_model
+from mbbatch import run_batch
+from mbprof import instrument
+from mbread import name_ids, read_oplsda, read_oplsda_model
 
 
-def sort_oplsda(ind, obj_names, kegg_lists):
+def _by_mid(kegg, ids):
+    # a 'mid' column left on the list would clash with the one om carries
+    kegg = kegg.drop(columns='mid', errors='ignore')
+    return kegg.set_axis(ids.encode(kegg.index))
 
-    om = read_oplsda(ind)
-    kegg_list, kegg_list_dn = kegg_lists
 
-    omup = om.join(kegg_list, on='Name').query('V1 > 1')
+def sort_oplsda(ind, obj_names, kegg_lists, met='neg'):
+
+    om = read_oplsda(ind, met)
+    # join on the integer metabolite ids rather than the name strings
+    ids = name_ids()
+    kegg_list, kegg_list_dn = (_by_mid(kegg, ids) for kegg in kegg_lists)
+
+    omup = om.join(kegg_list, on='mid').query('V1 > 1')
     omup.dropna(inplace=True)
     omup['direction'] = ['up' for i in range(len(omup.V1))]
 
-    omdn = om.join(kegg_list_dn, on='Name').query('V1 > 1')
+    omdn = om.join(kegg_list_dn, on='mid').query('V1 > 1')
     omdn.dropna(inplace=True)
     omdn['direction'] = ['down' for i in range(len(omdn.V1))]
-    omreg = omup.append(omdn)
+    omreg = pd.concat([omup, omdn])
     omreg = omreg.sort_values('V1', ascending=False).reset_index()
     return omreg
 
 
+def _oplsda_data(df_new):
+    # add_label_row output: a label row on top of features x samples
+    labels = df_new.iloc[0]
+    x = df_new.iloc[1:].to_numpy(dtype='float64').T
+    y = (labels != labels.iloc[0]).to_numpy(dtype='float64')
+    return x, y, df_new.index[1:]
+
+
+def _scale(x, y):
+    xm, xs = x.mean(axis=0), x.std(axis=0, ddof=1)
+    xs[xs == 0] = 1
+    return (x - xm) / xs, y - y.mean(), (xm, xs, y.mean())
+
+
+def _fit(x, y, n_ortho=1, method='opls'):
+
+    x = x.copy()
+    ssx = (x**2).sum()
+    model = {'method': method, 'ortho': [], 'pred': []}
+
+    if method == 'opls':
+        w = x.T @ y
+        w /= np.linalg.norm(w)
+        for _ in range(n_ortho):
+            t = x @ w
+            p = x.T @ t / (t @ t)
+            wo = p - (w @ p) * w
+            wo /= np.linalg.norm(wo)
+            to = x @ wo
+            po = x.T @ to / (to @ to)
+            x -= np.outer(to, po)
+            model['ortho'].append((wo, po))
+        t = x @ w
+        p = x.T @ t / (t @ t)
+        x -= np.outer(t, p)
+        model['pred'].append((w, p, y @ t / (t @ t), t))
+    elif method == 'plsda':
+        yr = y.copy()
+        for _ in range(n_ortho + 1):
+            w = x.T @ yr
+            w /= np.linalg.norm(w)
+            t = x @ w
+            p = x.T @ t / (t @ t)
+            c = yr @ t / (t @ t)
+            x -= np.outer(t, p)
+            yr = yr - c * t
+            model['pred'].append((w, p, c, t))
+    else:
+        raise ValueError(f'unknown model: {method}')
+
+    model['R2X'] = 1 - (x**2).sum() / ssx
+    return model
+
+
+def _predict(model, x):
+
+    if model['method'] == 'opls':
+        x = x.copy()
+        for wo, po in model['ortho']:
+            x -= np.outer(x @ wo, po)
+        w, _, c, _ = model['pred'][0]
+        return (x @ w) * c
+
+    w = np.column_stack([comp[0] for comp in model['pred']])
+    p = np.column_stack([comp[1] for comp in model['pred']])
+    c = np.array([comp[2] for comp in model['pred']])
+    return x @ (w @ np.linalg.solve(p.T @ w, c))
+
+
+def _vip(model):
+
+    w = np.column_stack([comp[0] for comp in model['pred']])
+    ssy = np.array(
+        [comp[2]**2 * (comp[3] @ comp[3]) for comp in model['pred']])
+    return np.sqrt(w.shape[0] * (w**2 @ ssy) / ssy.sum())
+
+
+def _folds(y, cv, seed):
+    # stratified, so every training split keeps both classes
+    cv = min(cv, int(min((y == 0).sum(), (y == 1).sum())))
+    rng = np.random.default_rng(seed)
+    folds = np.empty(len(y), dtype=int)
+    for label in np.unique(y):
+        idx = rng.permutation(np.flatnonzero(y == label))
+        folds[idx] = np.arange(len(idx)) % cv
+    return folds
+
+
+def _r2y_q2(x, y, folds, n_ortho, method):
+
+    xs, ys, _ = _scale(x, y)
+    model = _fit(xs, ys, n_ortho, method)
+    r2y = 1 - ((ys - _predict(model, xs))**2).sum() / (ys**2).sum()
+
+    press = 0
+    for fold in np.unique(folds):
+        test = folds == fold
+        xtr, ytr, (xm, xsd, ym) = _scale(x[~test], y[~test])
+        fold_model = _fit(xtr, ytr, n_ortho, method)
+        yhat = _predict(fold_model, (x[test] - xm) / xsd) + ym
+        press += ((y[test] - yhat)**2).sum()
+    q2 = 1 - press / ((y - y.mean())**2).sum()
+
+    return model, r2y, q2
+
+
+def _components(n_ortho, method):
+    # the rows of oplsda_model-{met}.csv, each cumulative up to that
+    # component: p1, o1, o2, ... for OPLS-DA and p1, p2, ... for PLS-DA
+    if method == 'opls':
+        return [(0, 'p1')] + [(k, f'o{k}') for k in range(1, n_ortho + 1)]
+    return [(k, f'p{k + 1}') for k in range(n_ortho + 1)]
+
+
+def fit_oplsda(df_new, n_ortho=1, method='opls', cv=7, seed=0):
+
+    x, y, names = _oplsda_data(df_new)
+    folds = _folds(y, cv, seed)
+
+    rows = []
+    for k, _ in _components(n_ortho, method):
+        model, r2y, q2 = _r2y_q2(x, y, folds, k, method)
+        rows.append([model['R2X'], r2y, q2])
+
+    # VIP from the full model, the last one fitted
+    vip = pd.DataFrame({'Name': names, 'V1': _vip(model)})
+    index = [name for _, name in _components(n_ortho, method)]
+    om = pd.DataFrame(rows,
+                      index=pd.Index(index, name='Name'),
+                      columns=['R2X(cum)', 'R2Y(cum)', 'Q2(cum)'])
+    return [vip, om]
+
+
+def _perm_chunk(x, y, folds, seeds, n_ortho, method):
+
+    scores = []
+
+    for seed in seeds:
+        yp = np.random.default_rng(seed).permutation(y)
+        _, r2y, q2 = _r2y_q2(x, yp, folds, n_ortho, method)
+        scores.append((r2y, q2))
+
+    return scores
+
+
+def perm_oplsda(df_new,
+                n_perm=200,
+                n_ortho=1,
+                method='opls',
+                cv=7,
+                seed=0,
+                workers=None):
+
+    x, y, _ = _oplsda_data(df_new)
+    folds = _folds(y, cv, seed)
+    _, r2y, q2 = _r2y_q2(x, y, folds, n_ortho, method)
+
+    # one child seed per permutation, so the draws do not depend on how
+    # the permutations are split across workers
+    seeds = np.random.SeedSequence(seed).spawn(n_perm)
+    n_chunks = max(1, min(n_perm, 4 * (workers or 1)))
+    tasks = [(x, y, folds, seeds[i::n_chunks], n_ortho, method)
+             for i in range(n_chunks)]
+    chunks = run_batch(_perm_chunk, tasks, workers=workers)
+
+    scores = np.empty((n_perm, 2))
+    for i, chunk in enumerate(chunks):
+        scores[i::n_chunks] = chunk
+    perms = pd.DataFrame(scores, columns=['R2Y', 'Q2'])
+
+    pvals = pd.Series({
+        'R2Y': ((perms['R2Y'] >= r2y).sum() + 1) / (n_perm + 1),
+        'Q2': ((perms['Q2'] >= q2).sum() + 1) / (n_perm + 1),
+    })
+    return [perms, pvals]
+
+
 def plot_vip(ax,
              omreg,
              title,
@@ -35,6 +222,7 @@ def plot_vip(ax,
              legendsize='x-large',
              ticksize='x-large',
              titlesize='xx-large'):
+    import matplotlib.pyplot as plt
 
     om1 = omreg.query('direction=="up"')
     om2 = omreg.query('direction=="down"')
@@ -76,9 +264,11 @@ def plot_oplsda_model(ax,
                       legendloc='lower right',
                       legendsize='x-large',
                       ticksize='x-large',
-                      titlesize='xx-large'):
+                      titlesize='xx-large',
+                      model=None):
+    import matplotlib.pyplot as plt
 
-    df = read_oplsda_model(ind)
+    df = read_oplsda_model(ind) if model is None else model
     barWidth = 0.2
 
     xs = np.arange(len(df.index))
@@ -98,3 +288,6 @@ def plot_oplsda_model(ax,
     ax.legend(loc=legendloc, fontsize=legendsize)
 
     return ax
+
+
+instrument(__name__)
@@ -0,0 +1,3 @@
+from mbfig.mbfig import (Panel, oplsda_model_panels, panel_digest,
+                         read_manifest, render_panel, render_panels,
+                         volcano_panels)
@@ -0,0 +1,119 @@
+import json
+import os
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from mbbatch import run_batch
+from mbdecomp import plot_oplsda_model
+from mbpipe import digest
+from mbread import read_oplsda_model
+from mbvolc import load_volc, plot_volcano
+
+# one figure with a single axes: plot(ax, *args, **kwargs) is saved as
+# <outdir>/<name>.<fmt>; plot must be a module-level function so panels
+# can be sent to worker processes
+Panel = namedtuple('Panel', ['name', 'plot', 'args', 'kwargs', 'figsize'],
+                   defaults=((), {}, (6.4, 4.8)))
+
+MANIFEST = 'manifest.json'
+
+
+def panel_digest(panel, formats=('png', ), dpi=150):
+
+    return digest(panel.plot, panel.args, panel.kwargs, panel.figsize,
+                  tuple(formats), dpi)
+
+
+def read_manifest(outdir):
+
+    path = os.path.join(outdir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest(outdir, manifest):
+
+    path = os.path.join(outdir, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def render_panel(panel, outdir, formats=('png', ), dpi=150):
+    # a bare Agg figure: no pyplot state and no backend switch, so this is
+    # safe both in pool workers and in an interactive session
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=panel.figsize)
+    panel.plot(fig.subplots(), *panel.args, **panel.kwargs)
+    files = []
+    for fmt in formats:
+        path = os.path.join(outdir, f'{panel.name}.{fmt}')
+        fig.savefig(path, dpi=dpi, bbox_inches='tight')
+        files.append(path)
+    return files
+
+
+def render_panels(panels,
+                  outdir='figures',
+                  formats=('png', ),
+                  dpi=150,
+                  workers=None,
+                  force=False):
+
+    os.makedirs(outdir, exist_ok=True)
+    manifest = read_manifest(outdir)
+
+    digests = [panel_digest(panel, formats, dpi) for panel in panels]
+    names = [panel.name for panel in panels]
+    if len(set(names)) < len(names):
+        raise ValueError('panel names must be unique')
+
+    # a panel is redrawn only when its inputs changed or an output is gone
+    todo = [
+        i for i, (panel, digest) in enumerate(zip(panels, digests))
+        if force or manifest.get(panel.name, {}).get('hash') != digest
+        or not all(map(os.path.exists, manifest[panel.name]['files']))
+    ]
+
+    tasks = [(panels[i], outdir, formats, dpi) for i in todo]
+    for i, files in zip(todo, run_batch(render_panel, tasks, workers=workers)):
+        manifest[names[i]] = {'hash': digests[i], 'files': files}
+    _write_manifest(outdir, manifest)
+
+    status = np.full(len(panels), 'skipped', dtype=object)
+    status[todo] = 'rendered'
+    return pd.DataFrame({'name': names, 'status': status, 'hash': digests})
+
+
+def volcano_panels(obj_names,
+                   mets=('neg', 'pos'),
+                   fcthr=2,
+                   pthr=0.05,
+                   modes=('fast', ),
+                   **kwargs):
+
+    panels = []
+    for met in mets:
+        for ind, obj in enumerate(obj_names, start=1):
+            volc_df = load_volc(ind, met)
+            for mode in modes:
+                panels.append(
+                    Panel(f'volcano-{obj}-{met}-{mode}', plot_volcano,
+                          (volc_df, f'{obj} ({met})'),
+                          dict(kwargs, fcthr=fcthr, pthr=pthr, mode=mode)))
+    return panels
+
+
+def oplsda_model_panels(obj_names, mets=('neg', ), **kwargs):
+
+    return [
+        Panel(f'oplsda-model-{obj}-{met}', plot_oplsda_model,
+              (ind, f'{obj} ({met})'),
+              dict(kwargs, model=read_oplsda_model(ind, met))) for met in mets
+        for ind, obj in enumerate(obj_names, start=1)
+    ]
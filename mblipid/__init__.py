@@ -1,2 +1,2 @@
-from mblipid.mblipid import (get_lipid_groups, get_lipids, join_lipids,
-                             plot_lipids_count)
+from mblipid.mblipid import (count_lipid_classes, get_lipid_groups, get_lipids,
+                             join_lipids, plot_lipids_count)
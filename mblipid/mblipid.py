@@ -1,63 +1,120 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from mbbatch import run_batch
+from mbprof import instrument
 from mbread import read_annol
-from mbvolc import check_volc_kegg, list_volc_sig
+from mbvolc import (kegg_index, kegg_mids, kegg_rows, list_volc_sig, load_volc,
+                    load_volcs, volc_sig)
 
+LIPID_LEVELS = ('CATEGORY', 'MAIN_CLASS', 'SUB_CLASS')
 
-def get_lipids(ind, obj_names, fcthr=2, pthr=0.05, direc='up', met='neg'):
 
-    annol = read_annol(ind, met)
-    annol.set_index('Name', inplace=True)
-
-    volc_list = list_volc_sig(obj_names,
-                              fcthr=fcthr,
-                              pthr=pthr,
-                              direc=direc,
-                              met=met)
-
-    kegg_list = check_volc_kegg(ind, volc_list, obj_names).index.to_frame()
-    kegg_list.index.name = ''
-
-    resl = kegg_list.join(annol, on='Name', how='inner')
-    lipid_df = resl[['CATEGORY', 'MAIN_CLASS', 'SUB_CLASS']]
-    lipid_df.index.name = 'Name'
-    return lipid_df
-
-
-def get_lipid_groups(obj_names, fcthr=2, pthr=0.05, direc='up', met='neg'):
+def _lipid_table(annol, index, names):
+    # significant names that have a KEGG map, with their Lipidmaps classes,
+    # joined on the integer metabolite ids
+    kegg_list = pd.DataFrame(
+        {'mid': kegg_mids(index)[kegg_rows(index, names)]})
+    resl = kegg_list.join(annol.set_index('mid'), on='mid', how='inner')
+    return resl.set_index('Name')[list(LIPID_LEVELS)]
 
-    lipid_groups = []
 
-    for ind, _ in enumerate(obj_names, start=1):
+def get_lipids(ind,
+               obj_names,
+               fcthr=2,
+               pthr=0.05,
+               direc='up',
+               met='neg',
+               volc_list=None):
 
-        lipid_df = get_lipids(ind,
-                              obj_names,
-                              fcthr=fcthr,
-                              pthr=pthr,
-                              direc=direc,
-                              met=met)
-        lipid_group = lipid_df.groupby(by='MAIN_CLASS').count()[['SUB_CLASS']]
-        lipid_groups.append(lipid_group)
+    annol = read_annol(ind, met)
 
-    return lipid_groups
+    if volc_list is None:
+        sig = volc_sig(load_volc(ind, met), fcthr=fcthr, pthr=pthr)
+        names = sig[direc if direc in ('up', 'down') else 'all']
+    else:
+        names = volc_list[obj_names[int(ind) - 1]].dropna()
 
+    return _lipid_table(annol, kegg_index(ind, met), names)
 
-def join_lipids(obj_names, titles, fcthr=2, pthr=0.05, direc='up', met='neg'):
 
-    lipid_groups = []
+def _lipid_counts(ind, volc_df, fcthr, pthr, met):
 
-    for ind, _ in enumerate(obj_names, start=1):
+    annol = read_annol(ind, met)
+    index = kegg_index(ind, met)
+    sig = volc_sig(volc_df, fcthr=fcthr, pthr=pthr)
+
+    counts = {}
+
+    for direc in ('up', 'down'):
+        lipid_df = _lipid_table(annol, index, sig[direc])
+        for level in LIPID_LEVELS:
+            for lipid, n in lipid_df[level].value_counts().items():
+                counts[(direc, level, lipid)] = n
+
+    # a three-level index even when nothing is significant, so projects
+    # without lipids still line up in count_lipid_classes
+    index = pd.MultiIndex.from_tuples(list(counts),
+                                      names=['direction', 'level', 'class'])
+    return pd.Series(list(counts.values()), index=index, dtype='int64')
+
+
+def count_lipid_classes(obj_names,
+                        fcthr=2,
+                        pthr=0.05,
+                        met='neg',
+                        volcs=None,
+                        workers=None):
+
+    if volcs is None:
+        volcs = load_volcs(obj_names, met, workers=workers)
+
+    tasks = [(ind, volc_df, fcthr, pthr, met)
+             for ind, volc_df in enumerate(volcs, start=1)]
+    counts = pd.concat(run_batch(_lipid_counts, tasks, workers=workers),
+                       axis=1,
+                       keys=obj_names)
+    counts.index.names = ['direction', 'level', 'class']
+    return counts.fillna(0).astype('int64').sort_index()
+
+
+def get_lipid_groups(obj_names,
+                     fcthr=2,
+                     pthr=0.05,
+                     direc='up',
+                     met='neg',
+                     workers=None):
 
-        lipid_df = get_lipids(ind,
-                              obj_names,
+    volc_list = list_volc_sig(obj_names,
                               fcthr=fcthr,
                               pthr=pthr,
                               direc=direc,
-                              met=met)
-        lipid_group = lipid_df.groupby(by='MAIN_CLASS').count()[['SUB_CLASS']]
-        lipid_groups.append(lipid_group)
+                              met=met,
+                              workers=workers)
+    tasks = [(ind, obj_names, fcthr, pthr, direc, met, volc_list)
+             for ind, _ in enumerate(obj_names, start=1)]
+    lipid_dfs = run_batch(get_lipids, tasks, workers=workers)
+
+    return [
+        lipid_df.groupby(by='MAIN_CLASS').count()[['SUB_CLASS']]
+        for lipid_df in lipid_dfs
+    ]
+
+
+def join_lipids(obj_names,
+                titles,
+                fcthr=2,
+                pthr=0.05,
+                direc='up',
+                met='neg',
+                workers=None):
+
+    lipid_groups = get_lipid_groups(obj_names,
+                                    fcthr=fcthr,
+                                    pthr=pthr,
+                                    direc=direc,
+                                    met=met,
+                                    workers=workers)
 
     lipid_total = pd.concat(lipid_groups, axis=1, join='outer')
     lipid_total.columns = titles
@@ -95,3 +152,6 @@ def plot_lipids_count(ax, df, titles, subtitle, baralpha=0.5):
 
     ax.set_yticks([x + barWidth / 2 - 0.005 for x in rs[1]])
     ax.set_title(subtitle)
+
+
+instrument(__name__)
@@ -0,0 +1,2 @@
+from mbpipe.mbpipe import (Pipeline, Ref, Stage, digest, file_digest,
+                           study_pipeline)
@@ -0,0 +1,358 @@
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from mbcorr import get_corr, get_diff_chem, get_diff_corr
+from mbdecomp import sort_oplsda
+from mbread import add_label_row, save_df
+from mbvolc import check_volc_kegg, list_volc_sig, list_volc_sig2, load_volcs
+
+# a placeholder for the output of an earlier stage
+Ref = namedtuple('Ref', ['stage'])
+# inputs are files hashed into the key; outputs are files the stage writes,
+# and a cached stage whose outputs are gone is run again
+Stage = namedtuple('Stage',
+                   ['name', 'func', 'args', 'kwargs', 'inputs', 'outputs'])
+
+
+def _feed(h, obj):
+
+    if isinstance(obj, pd.DataFrame) and 'mid' in obj.columns:
+        # name ids are assigned per process in first-seen order, so the
+        # same data would hash differently depending on what was read first
+        obj = obj.drop(columns='mid')
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        h.update(repr((type(obj).__name__, obj.shape)).encode())
+        if isinstance(obj, pd.DataFrame):
+            h.update(repr(list(obj.columns)).encode())
+        h.update(pd.util.hash_pandas_object(obj).to_numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        h.update(repr((obj.dtype.str, obj.shape)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}{len(obj)}'.encode())
+        for item in obj:
+            _feed(h, item)
+    elif isinstance(obj, dict):
+        h.update(f'dict{len(obj)}'.encode())
+        for key in sorted(obj, key=repr):
+            _feed(h, key)
+            _feed(h, obj[key])
+    elif isinstance(obj, functools.partial):
+        _feed(h, (obj.func, obj.args, obj.keywords))
+    elif callable(obj):
+        # the code and defaults are hashed too, so editing a stage function
+        # invalidates what it produced; instrumented wrappers are looked
+        # through
+        func = inspect.unwrap(obj)
+        h.update(f'{func.__module__}.{func.__qualname__}'.encode())
+        code = getattr(func, '__code__', None)
+        if code is not None:
+            _feed_code(h, code)
+            _feed(h, (func.__defaults__, func.__kwdefaults__))
+    else:
+        h.update(repr(obj).encode())
+
+
+def _feed_code(h, code):
+
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _feed_code(h, const)
+        elif isinstance(const, frozenset):
+            # set order follows string hashing, which varies per process
+            h.update(repr(sorted(map(repr, const))).encode())
+        else:
+            h.update(repr(const).encode())
+
+
+def digest(*objs):
+
+    h = hashlib.sha1()
+    _feed(h, objs)
+    return h.hexdigest()
+
+
+_file_digests = {}
+
+
+def file_digest(path):
+    # content hash, remembered per (mtime, size) so unchanged exports are
+    # not re-read on every run
+    if not os.path.exists(path):
+        return 'missing'
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    if key not in _file_digests:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        _file_digests[key] = h.hexdigest()
+    return _file_digests[key]
+
+
+class Pipeline:
+
+    def __init__(self, cache_dir='.mbpipe'):
+        self.cache_dir = cache_dir
+        self.stages = {}
+        self.last_run = []
+
+    def add(self, name, func, *args, inputs=(), outputs=(), **kwargs):
+
+        if name in self.stages:
+            raise ValueError(f'duplicate stage: {name}')
+        for dep in self._refs(args, kwargs):
+            if dep not in self.stages:
+                raise ValueError(f'unknown stage: {dep}')
+        self.stages[name] = Stage(name, func, args, kwargs, tuple(inputs),
+                                  tuple(outputs))
+        return Ref(name)
+
+    def set(self, name, **kwargs):
+
+        stage = self.stages[name]
+        self.stages[name] = stage._replace(kwargs={**stage.kwargs, **kwargs})
+
+    @staticmethod
+    def _refs(args, kwargs):
+        return [
+            arg.stage for arg in (*args, *kwargs.values())
+            if isinstance(arg, Ref)
+        ]
+
+    def deps(self, name):
+
+        stage = self.stages[name]
+        return self._refs(stage.args, stage.kwargs)
+
+    def _needed(self, targets):
+
+        needed = set()
+        todo = list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.deps(name))
+        # stages can only refer to earlier ones, so insertion order is a
+        # topological order
+        return [name for name in self.stages if name in needed]
+
+    def _key(self, name, keys):
+
+        stage = self.stages[name]
+
+        def sub(arg):
+            return ('ref', keys[arg.stage]) if isinstance(arg, Ref) else arg
+
+        args = [sub(arg) for arg in stage.args]
+        kwargs = {k: sub(v) for k, v in stage.kwargs.items()}
+        files = [(path, file_digest(path)) for path in stage.inputs]
+        return digest(stage.func, args, kwargs, files)
+
+    def _path(self, name, key):
+        return os.path.join(self.cache_dir, f'{name}-{key[:16]}.pkl')
+
+    def _fresh(self, name, key):
+        return os.path.exists(self._path(name, key)) and all(
+            map(os.path.exists, self.stages[name].outputs))
+
+    def _load(self, path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    def _store(self, path, value):
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def status(self, *targets):
+
+        names = self._needed(targets or self.stages)
+        keys = {}
+        for name in names:
+            keys[name] = self._key(name, keys)
+        status = pd.DataFrame({'stage': names})
+        status['key'] = [keys[name] for name in names]
+        status['cached'] = [self._fresh(name, keys[name]) for name in names]
+        return status
+
+    def run(self, *targets, force=False):
+
+        targets = targets or tuple(self.stages)
+        names = self._needed(targets)
+        keys, values = {}, {}
+        self.last_run = []
+
+        def value(name):
+            if name not in values:
+                values[name] = self._load(self._path(name, keys[name]))
+            return values[name]
+
+        for name in names:
+            # keys are taken in order, so files written by upstream stages
+            # are hashed after they have been produced
+            keys[name] = self._key(name, keys)
+            path = self._path(name, keys[name])
+            if self._fresh(name, keys[name]) and not force:
+                continue
+
+            stage = self.stages[name]
+
+            def sub(arg):
+                return value(arg.stage) if isinstance(arg, Ref) else arg
+
+            args = [sub(arg) for arg in stage.args]
+            kwargs = {k: sub(v) for k, v in stage.kwargs.items()}
+            values[name] = stage.func(*args, **kwargs)
+            self._store(path, values[name])
+            self.last_run.append(name)
+
+        if len(targets) == 1:
+            return value(targets[0])
+        return {name: value(name) for name in targets}
+
+
+def _save_upload(df_new, ind, obj, met):
+    # get_corr reads samples x metabolites back, so the add_label_row
+    # table is written transposed with its group labels as the first column
+    upload = df_new.T
+    upload.columns = ['Label'] + df_new.index[1:].tolist()
+    save_df(upload, ind, obj, met)
+    return f'Result-{ind}/{obj}-{met}.csv'
+
+
+def _upload_corr(upload, ind, obj_names, **kwargs):
+    # upload is the path _save_upload returned; taking it is what makes the
+    # save stage a dependency of the correlations
+    return get_corr(ind, obj_names, **kwargs)
+
+
+def _kegg_lists(ind, volc_lists, obj_names, met):
+    return [
+        check_volc_kegg(ind, volc_list, obj_names, met=met)
+        for volc_list in volc_lists
+    ]
+
+
+def study_pipeline(obj_names,
+                   met='neg',
+                   fcthr=2,
+                   pthr=0.05,
+                   direc='up',
+                   n=10,
+                   n_sample=None,
+                   n_reduced=40,
+                   g_names=None,
+                   cache_dir='.mbpipe'):
+
+    pipe = Pipeline(cache_dir)
+    volcs = pipe.add('volcs',
+                     load_volcs,
+                     obj_names,
+                     met,
+                     inputs=[
+                         f'Result-{ind}/volcano-{met}.csv'
+                         for ind, _ in enumerate(obj_names, start=1)
+                     ])
+    volc_list = pipe.add('volc_list',
+                         list_volc_sig,
+                         obj_names,
+                         fcthr=fcthr,
+                         pthr=pthr,
+                         direc=direc,
+                         met=met,
+                         volcs=volcs)
+    volc_lists = pipe.add('volc_lists',
+                          list_volc_sig2,
+                          obj_names,
+                          fcthr=fcthr,
+                          pthr=pthr,
+                          met=met,
+                          volcs=volcs)
+
+    for ind, obj in enumerate(obj_names, start=1):
+        kegg = pipe.add(
+            f'kegg-{ind}',
+            _kegg_lists,
+            ind,
+            volc_lists,
+            obj_names,
+            met,
+            inputs=[
+                f'Result-{ind}/2.MetAnnotation/KEGG/meta_{met}_kegg_anno.xls'
+            ])
+        pipe.add(f'oplsda-{ind}',
+                 sort_oplsda,
+                 ind,
+                 obj_names,
+                 kegg,
+                 met=met,
+                 inputs=[f'Result-{ind}/oplsda_vip-{met}.csv'])
+
+        # with g_names the upload table is produced here: add_label_row ->
+        # _save_upload writes the file get_corr reads back, and corr takes
+        # the written path so the save stage is scheduled before it;
+        # otherwise the upload is an input file like the exports
+        upload = f'Result-{ind}/{obj[0]}-{met}.csv'
+        if g_names is not None:
+            label = pipe.add(
+                f'label-{ind}',
+                add_label_row,
+                ind,
+                obj[0],
+                g_names[ind - 1],
+                n_sample,
+                met,
+                inputs=[f'Result-{ind}/1.MetQuant/meta_intensity_{met}.xls'])
+            saved = pipe.add(f'save-{ind}',
+                             _save_upload,
+                             label,
+                             ind,
+                             obj[0],
+                             met,
+                             outputs=[upload])
+            corr = pipe.add(f'corr-{ind}',
+                            _upload_corr,
+                            saved,
+                            ind,
+                            obj_names,
+                            direc=direc,
+                            met=met,
+                            volc_list=volc_list)
+        else:
+            corr = pipe.add(f'corr-{ind}',
+                            get_corr,
+                            ind,
+                            obj_names,
+                            direc=direc,
+                            met=met,
+                            volc_list=volc_list,
+                            inputs=[upload])
+        diff_corr = pipe.add(f'diff_corr-{ind}',
+                             get_diff_corr,
+                             ind,
+                             obj_names,
+                             n=n,
+                             n_sample=n_sample,
+                             direc=direc,
+                             met=met,
+                             corr=corr)
+        pipe.add(f'diff_chem-{ind}',
+                 get_diff_chem,
+                 diff_corr,
+                 n_reduced=n_reduced)
+
+    return pipe
@@ -0,0 +1 @@
+from mbprof.mbprof import Profile, instrument, record_hit, record_read
@@ -0,0 +1,227 @@
+import functools
+import inspect
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+# the active Profile, or None; checked once per call so instrumented
+# functions cost a global lookup when profiling is off
+_run = None
+
+
+def instrument(module_name):
+    # wrap the public functions defined in a module in place; called at
+    # the bottom of the module, before other modules import from it
+    module = sys.modules[module_name]
+    for name, func in list(vars(module).items()):
+        if (name.startswith('_') or not inspect.isfunction(func)
+                or func.__module__ != module_name
+                or hasattr(func, '__wrapped__')):
+            continue
+        setattr(module, name, _wrap(func))
+
+
+def _wrap(func):
+
+    # mbread.mbread.read_file is reported as mbread.read_file
+    name = f'{func.__module__.rpartition(".")[2]}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        run = _run
+        if run is None:
+            return func(*args, **kwargs)
+        return run.call(name, func, args, kwargs)
+
+    return wrapper
+
+
+def record_read(path, nbytes, kind='csv'):
+    run = _run
+    if run is not None:
+        run.read(path, nbytes, kind)
+
+
+def record_hit(path):
+    run = _run
+    if run is not None:
+        run.hit(path)
+
+
+_TREE_COLUMNS = ['path', 'depth', 'calls', 'total_s', 'self_s', 'peak_bytes']
+
+
+class _Frame:
+
+    __slots__ = ('path', 'child', 'start', 'peak')
+
+    def __init__(self, path, start=0):
+        self.path = path
+        self.child = 0.0
+        self.start = start
+        self.peak = 0
+
+
+class Profile:
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.calls = {}
+        self.files = {}
+        self.wall = 0.0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tracing = False
+
+    def __enter__(self):
+        global _run
+        if _run is not None:
+            raise RuntimeError('a profile is already active')
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+        self._t0 = time.perf_counter()
+        _run = self
+        return self
+
+    def __exit__(self, *exc):
+        global _run
+        _run = None
+        self.wall += time.perf_counter() - self._t0
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def call(self, name, func, args, kwargs):
+
+        stack = self._stack()
+        parent = stack[-1] if stack else None
+        frame = _Frame((parent.path if parent else ()) + (name, ))
+        if self.memory:
+            # the parent keeps the peak seen so far, then the counter is
+            # reset so this call measures its own
+            current, peak = tracemalloc.get_traced_memory()
+            if parent is not None:
+                parent.peak = max(parent.peak, peak)
+            tracemalloc.reset_peak()
+            frame.start = current
+        stack.append(frame)
+
+        t = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            dt = time.perf_counter() - t
+            stack.pop()
+            peak = 0
+            if self.memory:
+                peak = max(tracemalloc.get_traced_memory()[1], frame.peak)
+                if parent is not None:
+                    parent.peak = max(parent.peak, peak)
+                peak -= frame.start
+            if parent is not None:
+                parent.child += dt
+            with self._lock:
+                node = self.calls.setdefault(frame.path, [0, 0.0, 0.0, 0])
+                node[0] += 1
+                node[1] += dt
+                node[2] += dt - frame.child
+                node[3] = max(node[3], peak)
+
+    def _file(self, path):
+        if path not in self.files:
+            self.files[path] = dict(reads=0,
+                                    bytes=0,
+                                    hits=0,
+                                    kinds=[],
+                                    callers=[])
+        return self.files[path]
+
+    def read(self, path, nbytes, kind):
+
+        stack = self._stack()
+        caller = stack[-1].path[-1] if stack else None
+        with self._lock:
+            entry = self._file(path)
+            entry['reads'] += 1
+            entry['bytes'] += int(nbytes)
+            entry['kinds'].append(kind)
+            entry['callers'].append(caller)
+
+    def hit(self, path):
+
+        with self._lock:
+            self._file(path)['hits'] += 1
+
+    def tree(self):
+
+        rows = [(';'.join(path), len(path), *node)
+                for path, node in self.calls.items()]
+        tree = pd.DataFrame(rows, columns=_TREE_COLUMNS)
+        return tree.sort_values('path', ignore_index=True)
+
+    def functions(self):
+
+        tree = self.tree()
+        tree['function'] = tree['path'].str.rsplit(';', n=1).str[-1]
+        funcs = tree.groupby('function').agg(calls=('calls', 'sum'),
+                                             total_s=('total_s', 'sum'),
+                                             self_s=('self_s', 'sum'),
+                                             peak_bytes=('peak_bytes', 'max'))
+        return funcs.sort_values('total_s', ascending=False)
+
+    def reads(self):
+
+        reads = pd.DataFrame.from_dict(self.files, orient='index')
+        reads.index.name = 'path'
+        if reads.empty:
+            return reads
+        # a file parsed from disk more than once in a run
+        reads['duplicate'] = reads['reads'] > 1
+        return reads.sort_values('bytes', ascending=False)
+
+    def duplicate_reads(self):
+        return [
+            path for path, entry in self.files.items() if entry['reads'] > 1
+        ]
+
+    def report(self):
+
+        reads = self.reads()
+        return {
+            'wall_s': self.wall,
+            'memory': self.memory,
+            'functions': self.functions().reset_index().to_dict('records'),
+            'tree': self.tree().to_dict('records'),
+            'reads': reads.reset_index().to_dict('records'),
+            'files_read': int((reads['reads'] > 0).sum()) if len(reads) else 0,
+            'bytes_read': int(reads['bytes'].sum()) if len(reads) else 0,
+            'duplicates': self.duplicate_reads(),
+        }
+
+    def to_json(self, path):
+
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+
+    def to_collapsed(self, path=None):
+        # flamegraph.pl / speedscope collapsed stacks, self time in us
+        lines = [
+            f'{";".join(stack)} {round(node[2] * 1e6)}'
+            for stack, node in self.calls.items()
+        ]
+        text = '\n'.join(lines) + '\n'
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
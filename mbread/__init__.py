@@ -1,4 +1,14 @@
-from mbread.mbread import (add_label_row, get_rsd, get_values, read_anno,
-                           read_annol, read_file, read_oplsda,
-                           read_oplsda_model, read_upload_df, read_volcano,
-                           save_df, transform_df, unicodify)
+from mbread.mbread import (MODES, Contrasts, NameIndex, add_label_row,
+                           add_name_ids, add_unicode_map, both_dropped,
+                           cache_info, clear_cache, correct_drift,
+                           design_columns, design_groups, get_drift, get_qc,
+                           get_rsd, get_values, iter_file, lowess_matrix,
+                           mode_columns, name_ids, normalize, on_clear_cache,
+                           paired_columns, qc_columns, read_anno, read_annol,
+                           read_both, read_design, read_file, read_header,
+                           read_oplsda, read_oplsda_model, read_sidecar,
+                           read_upload_df, read_volcano, report_rsd,
+                           resolve_contrasts, run_order, save_df,
+                           set_both_rule, set_cache_budget, set_name_ids,
+                           standardize, transform_df, unicode_digest,
+                           unicodify, write_sidecar, write_sidecars)
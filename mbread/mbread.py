@@ -1,73 +1,930 @@
+import functools
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
 import pandas as pd
 
+from mbbatch import add_result_hook, run_batch
+from mbprof import instrument, record_hit, record_read
+
+MODES = ('neg', 'pos')
+
+CacheInfo = namedtuple('CacheInfo',
+                       ['hits', 'misses', 'evictions', 'currsize', 'maxsize'])
+
+
+class _TableCache:
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.currsize = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        # the two modes of met='both' are read from separate threads
+        self.lock = threading.RLock()
+
+    def get(self, key, stamp, columns=None):
+        with self.lock:
+            return self._get(key, stamp, columns)
+
+    def _get(self, key, stamp, columns):
+        df = self.lookup((key, columns), stamp)
+        if df is None and columns is not None:
+            # a projection can be served from any cached superset of it
+            for k in list(self.entries):
+                if k[0] == key and (k[1] is None or set(columns) <= set(k[1])):
+                    df = self.lookup(k, stamp)
+                    if df is not None:
+                        df = df[list(columns)]
+                        break
+        if df is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return df
+
+    def lookup(self, key, stamp):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] == stamp:
+            self.entries.move_to_end(key)
+            return entry[1]
+        self.discard(key)
+        return None
+
+    def put(self, key, stamp, df):
+        nbytes = int(df.memory_usage(index=True, deep=True).sum())
+        with self.lock:
+            self.discard(key)
+            if nbytes > self.maxsize:
+                return
+            self.entries[key] = (stamp, df, nbytes)
+            self.currsize += nbytes
+            self.shrink()
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.currsize -= entry[2]
+
+    def shrink(self):
+        while self.currsize > self.maxsize:
+            _, (_, _, nbytes) = self.entries.popitem(last=False)
+            self.currsize -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.currsize = 0
+
+
+_cache = _TableCache(512 * 2**20)
+
+
+def cache_info():
+    return CacheInfo(_cache.hits, _cache.misses, _cache.evictions,
+                     _cache.currsize, _cache.maxsize)
+
+
+# caches built on top of the readers elsewhere, dropped with this one
+_clear_hooks = []
+
+
+def on_clear_cache(hook):
+    if hook not in _clear_hooks:
+        _clear_hooks.append(hook)
+
+
+def clear_cache(stats=True):
+    _cache.clear()
+    _headers.clear()
+    _both_drops.clear()
+    for hook in _clear_hooks:
+        hook()
+    if stats:
+        _cache.hits = _cache.misses = _cache.evictions = 0
+
 
-def unicodify(df):
-    df['Name'] = df['Name'].str.replace('伪', 'α')
-    df['Name'] = df['Name'].str.replace('¦Â', 'α')
-    df['Name'] = df['Name'].str.replace('¦Á', 'α')
-    df['Name'] = df['Name'].str.replace('尾', 'β')
-    df['Name'] = df['Name'].str.replace('¦´', 'γ')
-    df['Name'] = df['Name'].str.replace('螖', 'δ')
-    df['Name'] = df['Name'].str.replace('¦¤', 'δ')
-    df['Name'] = df['Name'].str.replace('未', 'Δ')
-    df['Name'] = df['Name'].str.replace('¦Ä', 'Δ')
-    df['Name'] = df['Name'].str.replace('卤', '±')
-    df['Name'] = df['Name'].str.replace('¡À', '±')
+def set_cache_budget(nbytes):
+    _cache.maxsize = int(nbytes)
+    _cache.shrink()
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+_name_lock = threading.Lock()
+
+
+class NameIndex:
+
+    def __init__(self, names=()):
+        self.names = pd.Index(pd.unique(pd.Index(names).dropna()),
+                              dtype=object)
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, names):
+        names = pd.Index(names, dtype=object)
+        with _name_lock:
+            ids = self.names.get_indexer(names)
+            new = names[ids < 0].dropna().unique()
+            if len(new):
+                self.names = self.names.append(new)
+                ids = self.names.get_indexer(names)
+        return ids.astype('int32')
+
+    def decode(self, ids):
+        return self.names[ids].to_numpy()
+
+
+_name_ids = NameIndex()
+
+
+def name_ids():
+    return _name_ids
+
+
+def set_name_ids(ids):
+    global _name_ids
+    _name_ids = ids
+
+
+def add_name_ids(df):
+    # dense int32 ids for metabolite names, shared by every reader, so
+    # joins and set operations can run on integers
+    if 'Name' in df.columns:
+        df['mid'] = _name_ids.encode(df['Name'])
+    elif df.index.name == 'Name':
+        df['mid'] = _name_ids.encode(df.index)
     return df
 
 
-def read_file(ind: int, met='neg', unicode=True):
+def _rebind_ids(res):
+    # ids are per process, so tables built in a worker are re-encoded
+    # against this process's dictionary, or lose 'mid' without a Name
+    if isinstance(res, (list, tuple)):
+        items = [_rebind_ids(item) for item in res]
+        if hasattr(res, '_fields'):
+            # namedtuples take their fields positionally
+            return type(res)(*items)
+        return type(res)(items)
+    if isinstance(res, dict):
+        return {key: _rebind_ids(item) for key, item in res.items()}
+    if isinstance(res, pd.DataFrame) and 'mid' in res.columns:
+        if 'Name' in res.columns or res.index.name == 'Name':
+            return add_name_ids(res)
+        return res.drop(columns='mid')
+    return res
 
-    path = f'Result-{ind}/1.MetQuant/meta_intensity_{met}.xls'
-    df = pd.read_table(path, sep='\t', encoding_errors='ignore', index_col=0)
-    if unicode:
-        df = unicodify(df)
+
+add_result_hook(_rebind_ids)
+
+# pandas 3 always copies on write
+_COPY_ON_WRITE = int(pd.__version__.split('.')[0]) >= 3
+
+
+def _private(df):
+    # callers get their own frame because most of them mutate it in place;
+    # under copy-on-write a shallow copy is enough, and sidecar columns
+    # then stay on the mapped pages that workers share
+    return df.copy(deep=not _COPY_ON_WRITE)
+
+
+def _cached(ind, met, path, parse, variant=None, columns=None):
+    # entries are stamped with mtime and size, so an edited export is
+    # re-parsed
+    stamp = _stamp(path)
+    key = (ind, met, path, variant)
+    df = _cache.get(key, stamp, columns)
+    if df is None:
+        df = parse(path)
+        _cache.put((key, columns), stamp, df)
+    else:
+        record_hit(path)
+    return add_name_ids(_private(df))
+
+
+def write_sidecar(path, sep=','):
+    df = pd.read_csv(path, sep=sep, encoding_errors='ignore', index_col=0)
+    side = f'{path}.mbc'
+    os.makedirs(side, exist_ok=True)
+
+    numeric = df.select_dtypes('float64').columns
+    np.save(f'{side}/values.npy',
+            np.ascontiguousarray(df[numeric].to_numpy(), dtype='float64'))
+    # the column list on its own, so read_header does not load the rest
+    with open(f'{side}/header.json', 'w') as f:
+        json.dump({'stamp': _stamp(path), 'columns': df.columns.tolist()}, f)
+    meta = {
+        'stamp': _stamp(path),
+        'columns': df.columns.tolist(),
+        'numeric': numeric.tolist(),
+        'index': df.index,
+        'rest': df.drop(columns=numeric),
+    }
+    # meta goes last and carries the source stamp, so an interrupted
+    # conversion is seen as stale rather than read half-written
+    pd.to_pickle(meta, f'{side}/meta.pkl.tmp')
+    os.replace(f'{side}/meta.pkl.tmp', f'{side}/meta.pkl')
+    return side
+
+
+def write_sidecars(ind, met='neg'):
+    paths = [
+        (f'Result-{ind}/1.MetQuant/meta_intensity_{met}.xls', '\t'),
+        (f'Result-{ind}/2.MetAnnotation/KEGG/meta_{met}_kegg_anno.xls', '\t'),
+        (f'Result-{ind}/2.MetAnnotation/Lipidmaps/meta_{met}_lipidmaps_anno.xls',
+         '\t'),
+        (f'Result-{ind}/volcano-{met}.csv', ','),
+        (f'Result-{ind}/oplsda_vip-{met}.csv', ','),
+    ]
+    return [
+        write_sidecar(path, sep) for path, sep in paths if os.path.exists(path)
+    ]
+
+
+def read_sidecar(path):
+    side = f'{path}.mbc'
+    try:
+        meta = pd.read_pickle(f'{side}/meta.pkl')
+    except FileNotFoundError:
+        return None
+    if meta['stamp'] != _stamp(path):
+        return None
+
+    # a private copy-on-write mapping: pages stay shared between processes
+    # until written, and a write never reaches the sidecar, so the frames
+    # handed out are writable whether or not the cache still holds them
+    values = np.load(f'{side}/values.npy', mmap_mode='c')
+    record_read(path, values.nbytes + os.path.getsize(f'{side}/meta.pkl'),
+                'sidecar')
+    df = pd.DataFrame(values,
+                      index=meta['index'],
+                      columns=meta['numeric'],
+                      copy=False)
+    rest = meta['rest']
+    for loc, col in enumerate(meta['columns']):
+        if col in rest.columns:
+            df.insert(loc, col, rest[col].array)
     return df
 
 
-def get_rsd(ind: int, met='neg', unicode=True):
+def _read_table(path, sep='\t', usecols=None, chunksize=None):
+    df = read_sidecar(path)
+    if df is not None:
+        if usecols is not None:
+            df = df[list(usecols)]
+        if chunksize is not None:
+            return (df.iloc[i:i + chunksize]
+                    for i in range(0, len(df), chunksize))
+        return df
 
-    df = read_file(ind, met, unicode=unicode)
-    qcs = [f'{met}_QC{i}' for i in range(1, 4)]
-    rsd = df[qcs].apply(lambda x: x.std() / x.mean(), axis=1)
+    record_read(path, os.path.getsize(path))
+    if usecols is not None:
+        header = pd.read_csv(path, sep=sep, encoding_errors='ignore', nrows=0)
+        usecols = [header.columns[0]] + list(usecols)
+    df = pd.read_csv(path,
+                     sep=sep,
+                     encoding_errors='ignore',
+                     index_col=0,
+                     usecols=usecols,
+                     chunksize=chunksize)
+    if usecols is not None and chunksize is None:
+        df = df[usecols[1:]]
+    return df
+
+
+def _compact(df, ratio=0.5):
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == 'float64':
+            df[col] = values.astype('float32')
+        elif values.dtype == object or values.dtype == 'string':
+            if values.nunique() < ratio * len(values):
+                df[col] = values.astype('category')
+    return df
+
+
+_GREEK = {
+    '伪': 'α',
+    '¦Â': 'α',
+    '¦Á': 'α',
+    '尾': 'β',
+    '¦´': 'γ',
+    '螖': 'δ',
+    '¦¤': 'δ',
+    '未': 'Δ',
+    '¦Ä': 'Δ',
+    '卤': '±',
+    '¡À': '±',
+}
+
+
+def _compile_greek(mapping):
+    keys = sorted(mapping, key=len, reverse=True)
+    return re.compile('|'.join(re.escape(key) for key in keys))
+
+
+_GREEK_RE = _compile_greek(_GREEK)
+
+
+def unicode_digest():
+    # changes with the name mapping, for caches that hold unicodified names
+    h = hashlib.sha1(repr(sorted(_GREEK.items())).encode())
+    return int(h.hexdigest()[:15], 16)
+
+
+def add_unicode_map(mapping):
+    global _GREEK_RE
+    _GREEK.update(mapping)
+    _GREEK_RE = _compile_greek(_GREEK)
+    clear_cache(stats=False)
+
+
+def _unicodify_values(values, pattern, mapping):
+    if values.dtype == 'category':
+        return _unicodify_values(values.astype(object), pattern,
+                                 mapping).astype('category')
+
+    # names repeat across rows, so fix each distinct string once and
+    # take the fixes back by code in one pass
+    codes, uniques = pd.factorize(values)
+    repl = lambda m: mapping[m.group(0)]
+    fixed = [
+        pattern.sub(repl, u) if isinstance(u, str) else u for u in uniques
+    ]
+    fixed = pd.api.extensions.take(np.asarray(fixed, dtype=object),
+                                   codes,
+                                   allow_fill=True)
+    return pd.Series(fixed, index=values.index, dtype=values.dtype)
+
+
+def _is_text(values):
+    return values.dtype == object or values.dtype in ('string', 'category')
+
+
+def unicodify(df, mapping=None):
+    if mapping is None:
+        pattern, mapping = _GREEK_RE, _GREEK
+    else:
+        mapping = {**_GREEK, **mapping}
+        pattern = _compile_greek(mapping)
+
+    for col in df.columns:
+        if _is_text(df[col]):
+            df[col] = _unicodify_values(df[col], pattern, mapping)
+    if _is_text(df.index):
+        index = _unicodify_values(df.index.to_series(), pattern, mapping)
+        df.index = pd.Index(index, name=df.index.name)
+    return df
+
+
+_headers = {}
+
+
+def _sidecar_header(path, stamp):
+    side = f'{path}.mbc/header.json'
+    try:
+        with open(side) as f:
+            header = json.load(f)
+    except FileNotFoundError:
+        return None
+    if tuple(header['stamp']) != stamp:
+        return None
+    record_read(side, os.path.getsize(side), 'header')
+    return header['columns']
+
+
+def read_header(ind: int, met='neg'):
+    if hasattr(ind, 'header'):
+        return ind.header(met)
+    if met == 'both':
+        cols = [
+            _both_column(col, m) for m in MODES for col in read_header(ind, m)
+        ]
+        return list(dict.fromkeys(cols)) + ['mode']
+    path = f'Result-{ind}/1.MetQuant/meta_intensity_{met}.xls'
+    # remembered per source stamp: qc_columns and read_design ask again
+    stamp = _stamp(path)
+    entry = _headers.get(path)
+    if entry is None or entry[0] != stamp:
+        cols = _sidecar_header(path, stamp)
+        if cols is None:
+            cols = pd.read_table(path,
+                                 sep='\t',
+                                 encoding_errors='ignore',
+                                 index_col=0,
+                                 nrows=0).columns.tolist()
+        entry = _headers[path] = (stamp, cols)
+    return list(entry[1])
+
+
+def read_file(ind: int, met='neg', unicode=True, usecols=None, compact=False):
+    if hasattr(ind, 'read_file'):
+        return ind.read_file(met,
+                             unicode=unicode,
+                             usecols=usecols,
+                             compact=compact)
+    if met == 'both':
+        return read_both(read_file,
+                         ind,
+                         usecols=usecols,
+                         unicode=unicode,
+                         compact=compact)
+
+    path = f'Result-{ind}/1.MetQuant/meta_intensity_{met}.xls'
+    if usecols is not None:
+        usecols = tuple(usecols)
+
+    def parse(path):
+        df = _read_table(path, usecols=usecols)
+        if unicode:
+            df = unicodify(df)
+        return _compact(df) if compact else df
+
+    return _cached(ind,
+                   met,
+                   path,
+                   parse,
+                   variant=(unicode, compact),
+                   columns=usecols)
 
-    thres = rsd[rsd < 0.3].shape[0] / rsd.shape[0]
 
-    qcsm = df[qcs].mean(axis=1)
+def iter_file(ind: int,
+              met='neg',
+              unicode=True,
+              usecols=None,
+              compact=False,
+              chunksize=10000):
+
+    path = f'Result-{ind}/1.MetQuant/meta_intensity_{met}.xls'
+    for df in _read_table(path, usecols=usecols, chunksize=chunksize):
+        if unicode:
+            df = unicodify(df)
+        yield _compact(df) if compact else df
+
+
+def qc_columns(ind: int, met='neg'):
+    pattern = re.compile(rf'{met}_QC(\d+)$')
+    qcs = [col for col in read_header(ind, met) if pattern.match(col)]
+    return sorted(qcs, key=lambda col: int(pattern.match(col).group(1)))
+
+
+def mode_columns(cols, met='neg'):
+    # sample columns may be given with or without the mode prefix
+    return [
+        col if col.startswith(f'{met}_') else f'{met}_{col}'
+        for col in pd.Index(cols).astype(str)
+    ]
+
+
+def read_design(ind, met='neg', design=None):
+    # sample -> group, pair and batch: an explicit table, else
+    # Result-{ind}/design.csv, else parsed from the <group><replicate>
+    # sample columns of the export, with equal replicates paired
+    if design is None:
+        path = f'Result-{ind}/design.csv'
+        if os.path.exists(path):
+            design = pd.read_csv(path, index_col=0)
+
+    qcs = set(qc_columns(ind, met))
+    cols = [
+        col for col in read_header(ind, met)
+        if col.startswith(f'{met}_') and col not in qcs
+    ]
+    if design is None:
+        pattern = re.compile(rf'{met}_(.+?)(\d+)$')
+        matches = [m for m in map(pattern.match, cols) if m]
+        design = pd.DataFrame(
+            {
+                'group': [m.group(1) for m in matches],
+                'pair': [int(m.group(2)) for m in matches]
+            },
+            index=[m.group(0) for m in matches])
+        # replicates in numeric order within each group
+        design = design.sort_values('pair', kind='stable')
+    design = design.copy()
+    if 'pair' not in design.columns:
+        design['pair'] = np.nan
+    if 'batch' not in design.columns:
+        design['batch'] = 1
+    design.index = mode_columns(design.index, met)
+    design['group'] = design['group'].astype(str)
+    return design[design.index.isin(cols)][['group', 'pair', 'batch']]
+
+
+def design_columns(design, groups):
+    # the sample columns of the given groups, group by group
+    return [
+        col for group in groups
+        for col in design.index[design['group'] == group]
+    ]
+
+
+def paired_columns(design, ref, case):
+    # ref and case samples matched on their pair id
+    pairs = [
+        design.loc[design['group'] == group, 'pair'].dropna()
+        for group in (ref, case)
+    ]
+    pairs = [p[~p.duplicated()] for p in pairs]
+    common = pairs[0][pairs[0].isin(pairs[1])].sort_values()
+    lookup = pd.Series(pairs[1].index, index=pairs[1].to_numpy())
+    return common.index.tolist(), lookup[common.to_numpy()].tolist()
+
+
+Contrasts = namedtuple('Contrasts', [
+    'names', 'columns', 'groups', 'group_of', 'ref', 'case', 'pair_ref',
+    'pair_case', 'pair_of'
+])
+
+
+def resolve_contrasts(design, contrasts=None):
+    # every contrast turned into integer positions once: group indices for
+    # the means and column positions for the pairs; contrasts map a name
+    # to (ref, case) groups, a list of such tuples is named <case>-vs-<ref>,
+    # and None compares every group with each later one
+    groups = design['group'].unique().tolist()
+    if contrasts is None:
+        contrasts = [(ref, case) for i, ref in enumerate(groups)
+                     for case in groups[i + 1:]]
+    if not isinstance(contrasts, dict):
+        contrasts = {
+            f'{case}-vs-{ref}': (ref, case)
+            for ref, case in contrasts
+        }
+    for ref, case in contrasts.values():
+        for group in (ref, case):
+            if group not in groups:
+                raise KeyError(f'group not in the design: {group}')
+
+    used = {group for pair in contrasts.values() for group in pair}
+    groups = [group for group in groups if group in used]
+    columns = design_columns(design, groups)
+    group_pos = {group: i for i, group in enumerate(groups)}
+    col_pos = {col: i for i, col in enumerate(columns)}
+
+    pair_ref, pair_case, pair_of = [], [], []
+    for k, (ref, case) in enumerate(contrasts.values()):
+        ref_cols, case_cols = paired_columns(design, ref, case)
+        pair_ref += [col_pos[col] for col in ref_cols]
+        pair_case += [col_pos[col] for col in case_cols]
+        pair_of += [k] * len(ref_cols)
+
+    return Contrasts(
+        list(contrasts), columns, groups,
+        np.array([group_pos[g] for g in design.loc[columns, 'group']]),
+        np.array([group_pos[ref] for ref, _ in contrasts.values()]),
+        np.array([group_pos[case] for _, case in contrasts.values()]),
+        np.array(pair_ref, dtype=int), np.array(pair_case, dtype=int),
+        np.array(pair_of, dtype=int))
+
+
+def design_groups(design, obj, groups=None):
+    # the (ref, case) groups of a project: as given, else <obj>r and <obj>,
+    # else the only two groups of the design
+    names = design['group'].unique().tolist()
+    if groups is None:
+        if f'{obj}r' in names and obj in names:
+            groups = (f'{obj}r', obj)
+        elif len(names) == 2:
+            groups = tuple(names)
+        else:
+            raise KeyError(f'cannot tell the groups of {obj} from the '
+                           f'design, pass groups=(ref, case): {names}')
+    for group in groups:
+        if group not in names:
+            raise KeyError(f'group not in the design: {group}')
+    return tuple(groups)
+
+
+def _value_columns(ind, obj, met, groups=None):
+    # the reference group, then the case group
+    design = read_design(ind, met)
+    return design_columns(design, design_groups(design, obj, groups))
+
+
+def _row_rsd(values):
+    # NaN-aware row mean and sample std in array ops, matching what
+    # DataFrame.std/mean skip
+    valid = ~np.isnan(values)
+    count = valid.sum(axis=1)
+    filled = np.where(valid, values, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = filled.sum(axis=1) / count
+        dev = np.where(valid, values - mean[:, None], 0)
+        std = np.sqrt((dev**2).sum(axis=1) / (count - 1))
+        return mean, std / mean
+
+
+def get_qc(ind: int,
+           met='neg',
+           rsd_thr=0.3,
+           unicode=True,
+           compact=False,
+           drift=False,
+           order=None):
+
+    qcs = qc_columns(ind, met)
+    if drift:
+        # QCs corrected by fits that leave them out, so the RSD is not
+        # shrunk by the curve passing through the very points it measures
+        df = get_drift(ind, met, order=order, unicode=unicode,
+                       holdout=True)[qcs]
+    else:
+        df = read_file(ind, met, unicode=unicode, usecols=qcs, compact=compact)
+    mean, rsd = _row_rsd(df.to_numpy(dtype='float64'))
+
+    qc = pd.DataFrame({'qc_mean': mean, 'rsd': rsd}, index=df.index)
+    qc['pass'] = rsd < rsd_thr
+    return qc
+
+
+def get_rsd(ind: int,
+            met='neg',
+            unicode=True,
+            compact=False,
+            rsd_thr=0.3,
+            drift=False,
+            order=None):
+
+    qc = get_qc(ind,
+                met,
+                rsd_thr=rsd_thr,
+                unicode=unicode,
+                compact=compact,
+                drift=drift,
+                order=order)
+    thres = qc['pass'].mean()
+    qcsm = qc['qc_mean']
 
     return thres, qcsm
 
 
-def get_values(ind, obj, met='neg', unicode=True):
+def report_rsd(obj_names, mets=('neg', 'pos'), rsd_thr=0.3, drift=False):
+
+    rows = []
+
+    for ind, obj in enumerate(obj_names, start=1):
+        for met in mets:
+            qc = get_qc(ind, met, rsd_thr=rsd_thr)
+            row = {
+                'project': obj,
+                'met': met,
+                'QC': len(qc_columns(ind, met)),
+                'features': len(qc),
+                'passed': int(qc['pass'].sum()),
+                'pass_fraction': qc['pass'].mean(),
+                'median_rsd': qc['rsd'].median(),
+            }
+            if drift:
+                # the same figures after drift correction
+                qc = get_qc(ind, met, rsd_thr=rsd_thr, drift=True)
+                row['passed_drift'] = int(qc['pass'].sum())
+                row['pass_fraction_drift'] = qc['pass'].mean()
+                row['median_rsd_drift'] = qc['rsd'].median()
+            rows.append(row)
+
+    return pd.DataFrame(rows).set_index(['project', 'met'])
+
+
+def get_values(ind, obj, met='neg', unicode=True, compact=False, groups=None):
+    return read_file(ind,
+                     met,
+                     unicode=unicode,
+                     usecols=_value_columns(ind, obj, met, groups),
+                     compact=compact)
+
+
+def normalize(values, qcsm=None, method='qc'):
+    # values is a features x samples array and is scaled in place
+    if method == 'qc':
+        values /= qcsm[:, None]
+    elif method == 'pqn':
+        quotients = values / qcsm[:, None]
+        values /= np.nanmedian(quotients, axis=0)
+    elif method == 'tic':
+        totals = np.nansum(values, axis=0)
+        values *= np.nanmean(totals) / totals
+    elif method == 'median':
+        values /= np.nanmedian(values, axis=0)
+    else:
+        raise ValueError(f'unknown normalization: {method}')
+    return values
+
+
+def standardize(values):
+    values -= np.nanmean(values, axis=0)
+    values /= np.nanstd(values, axis=0, ddof=1)
+    return values
+
+
+def run_order(ind, met='neg', order=None):
+    # injection order and analytical batch of every QC and sample column:
+    # an explicit table, else Result-{ind}/run_order-{met}.csv, else the
+    # column order of the export as a single batch
+    if order is None:
+        path = f'Result-{ind}/run_order-{met}.csv'
+        if os.path.exists(path):
+            order = pd.read_csv(path, index_col=0)
+
+    cols = [col for col in read_header(ind, met) if col.startswith(f'{met}_')]
+    if order is None:
+        order = pd.DataFrame({'order': np.arange(1,
+                                                 len(cols) + 1)},
+                             index=cols)
+    order = order.copy()
+    if 'batch' not in order.columns:
+        order['batch'] = 1
+    order.index = mode_columns(order.index, met)
+    return order.reindex(cols)[['order', 'batch']].dropna(subset=['order'])
+
+
+def lowess_matrix(x, t, frac=0.75):
+    # local linear LOWESS with tricube weights is linear in y once x is
+    # fixed: the fit at t is S @ y, so one matrix smooths every feature
+    x = np.asarray(x, dtype='float64')
+    t = np.asarray(t, dtype='float64')
+    k = min(len(x), max(2, int(np.ceil(frac * len(x)))))
+
+    dist = np.abs(t[:, None] - x[None, :])
+    h = np.sort(dist, axis=1)[:, k - 1]
+    h = np.where(h > 0, h, 1)
+    w = np.clip(1 - (dist / h[:, None])**3, 0, None)**3
+
+    s0 = w.sum(axis=1)[:, None]
+    s1 = (w * x).sum(axis=1)[:, None]
+    s2 = (w * x**2).sum(axis=1)[:, None]
+    det = s0 * s2 - s1**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S = w * (s2 - s1 * x + t[:, None] * (s0 * x - s1)) / det
+    # a neighbourhood with a single distinct x falls back to its mean, or
+    # to the mean of all x when every weight is zero
+    flat = (np.abs(det) <= 1e-12 * s0**2)[:, 0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S[flat] = np.where(s0[flat] > 0, w[flat] / s0[flat], 1 / len(x))
+    return S
+
+
+def _holdout_matrix(x, frac=0.75):
+    # row i smooths the QCs other than i and evaluates at x[i]
+    S = np.zeros((len(x), len(x)))
+    for i in range(len(x)):
+        keep = np.arange(len(x)) != i
+        S[i, keep] = lowess_matrix(x[keep], x[i:i + 1], frac)[0]
+    return S
+
+
+def _drift_block(qc_values, values, S):
+    # missing QC values take the feature's QC median before smoothing
+    med = np.nanmedian(qc_values, axis=1, keepdims=True)
+    qc_values = np.where(np.isnan(qc_values), med, qc_values)
+    fit = qc_values @ S.T
+    fit = np.where(np.isfinite(fit) & (fit > 0), fit, med)
+    return values / fit
+
+
+def correct_drift(values,
+                  order,
+                  batch,
+                  qc,
+                  frac=0.75,
+                  workers=None,
+                  block=4096,
+                  min_qc=3,
+                  holdout=False):
+    # values is features x columns; each batch is fitted on its own QCs
+    # and every batch is brought to the QC median over all batches. A batch
+    # with fewer than min_qc QCs is left as it is: the curve would pass
+    # through its QCs and say nothing. With holdout, every QC is corrected
+    # by a fit that leaves it out, so QC RSDs after correction are
+    # out-of-sample
+    values = np.asarray(values, dtype='float64')
+    order = np.asarray(order, dtype='float64')
+    batch = np.asarray(batch)
+    qc = np.asarray(qc, dtype=bool)
+
+    tasks, targets, fitted = [], [], []
+    for b in pd.unique(batch):
+        cols = np.flatnonzero(batch == b)
+        qcs = cols[qc[cols]]
+        if len(qcs) < max(min_qc, 2 if holdout else 1):
+            continue
+        fitted.append(b)
+        S = lowess_matrix(order[qcs], order[cols], frac)
+        if holdout:
+            S[np.isin(cols, qcs)] = _holdout_matrix(order[qcs], frac)
+        for start in range(0, len(values), block):
+            rows = slice(start, start + block)
+            tasks.append((values[rows, qcs], values[rows, cols], S))
+            targets.append((rows, cols))
+
+    out = values.copy()
+    for (rows,
+         cols), res in zip(targets,
+                           run_batch(_drift_block, tasks, workers=workers)):
+        out[rows, cols] = res
+    with np.errstate(all='ignore'):
+        level = np.nanmedian(values[:, qc], axis=1)
+    fitted = np.isin(batch, fitted)
+    out[:, fitted] *= level[:, None]
+    return out
+
+
+def get_drift(ind,
+              met='neg',
+              order=None,
+              frac=0.75,
+              workers=None,
+              unicode=True,
+              min_qc=3,
+              holdout=False):
+    if met == 'both':
+        return read_both(get_drift,
+                         ind,
+                         order=order,
+                         frac=frac,
+                         workers=workers,
+                         unicode=unicode,
+                         min_qc=min_qc,
+                         holdout=holdout)
+
+    runs = run_order(ind, met, order)
+    cols = runs.index.tolist()
     df = read_file(ind, met, unicode=unicode)
-    col_1 = [f'{met}_{obj}r{i}' for i in range(1, 7)]
-    col_2 = [f'{met}_{obj}{i}' for i in range(1, 7)]
-    return df[col_1 + col_2]
+    qc = np.isin(cols, qc_columns(ind, met))
+    df[cols] = correct_drift(df[cols].to_numpy(dtype='float64'),
+                             runs['order'],
+                             runs['batch'],
+                             qc,
+                             frac=frac,
+                             workers=workers,
+                             min_qc=min_qc,
+                             holdout=holdout)
+    return df
+
 
+def transform_df(ind,
+                 obj,
+                 met='neg',
+                 standard=True,
+                 norm='qc',
+                 compact=False,
+                 drift=False,
+                 order=None,
+                 groups=None):
+    if drift:
+        df = get_drift(ind, met, order=order)
+        mean, _ = _row_rsd(df[qc_columns(ind, met)].to_numpy(dtype='float64'))
+        qcsm = pd.Series(mean, index=df.index)
+        g = df[_value_columns(ind, obj, met, groups)]
+    else:
+        _, qcsm = get_rsd(ind, met)
+        g = get_values(ind, obj, met, compact=compact, groups=groups)
 
-def transform_df(ind, obj, met='neg', standard=True):
-    _, qcsm = get_rsd(ind, met)
-    g = get_values(ind, obj, met)
-    transf_df = g.copy()
-    for col in g.columns:
-        transf_df[col] = g[col] / qcsm
+    # get_values hands out a private copy, so its array is scaled in place
+    values = g.to_numpy(dtype='float32' if compact else 'float64')
+    if not values.flags.writeable:
+        values = values.copy()
+    normalize(values, qcsm.to_numpy(dtype=values.dtype), method=norm)
     if standard:
-        transf_df = transf_df.apply(lambda x: (x - x.mean()) / x.std())
-    return transf_df
+        standardize(values)
+    return pd.DataFrame(values, index=g.index, columns=g.columns, copy=False)
 
 
 def add_label_row(ind: int,
                   obj: str,
                   g_names: list,
-                  n: int,
+                  n: int = None,
                   met='neg',
                   standard=True,
-                  unicode=True):
+                  unicode=True,
+                  groups=None):
 
-    df = read_file(ind, met, unicode=unicode)
-    transf_df = transform_df(ind, obj, met, standard=True)
+    # one projected read that get_rsd and get_values are then served from
+    design = read_design(ind, met)
+    groups = design_groups(design, obj, groups)
+    usecols = ['Name'] + qc_columns(ind, met) + design_columns(design, groups)
+    df = read_file(ind, met, unicode=unicode, usecols=usecols)
+    transf_df = transform_df(ind, obj, met, standard=True, groups=groups)
 
-    labs = [f'{obj}-{g_names[0]}'] * n + [f'{obj}-{g_names[1]}'] * n
+    # one label per sample from the design, so the groups may differ in
+    # size; n is no longer needed
+    names = dict(zip(groups, g_names))
+    labs = [
+        f'{obj}-{names[group]}'
+        for group in design.loc[transf_df.columns, 'group']
+    ]
     transf_df.index = df.Name
 
     labels = pd.DataFrame([labs], columns=transf_df.columns)
@@ -83,36 +940,196 @@ def save_df(df_new, ind, obj, met='neg'):
 
 def read_upload_df(ind, obj, met='neg'):
     path = f'Result-{ind}/{obj}-{met}.csv'
+    record_read(path, os.path.getsize(path))
     return pd.read_csv(path, index_col=0)
 
 
-def read_anno(ind: int, met='neg'):
+def _read_unicode(path, unicode, sep='\t'):
+    df = _read_table(path, sep=sep)
+    return unicodify(df) if unicode else df
+
+
+_both_rule = 'rsd'
+_both_drops = {}
+
+
+def set_both_rule(rule):
+    # how a metabolite detected in both modes is resolved for met='both':
+    # 'rsd' keeps the mode with the lower QC RSD, 'mean' the one with the
+    # higher QC mean, 'neg' or 'pos' always that mode, None keeps both
+    global _both_rule
+    if rule not in (None, 'rsd', 'mean') + MODES:
+        raise ValueError(f'unknown rule: {rule}')
+    _both_rule = rule
+    _both_drops.clear()
+
+
+def _read_modes(reader, ind, **kwargs):
+    # both modes at once; the parsers release the GIL for most of a read
+    tasks = [(ind, met) for met in MODES]
+    return run_batch(functools.partial(reader, **kwargs),
+                     tasks,
+                     workers=len(MODES),
+                     kind='thread')
+
+
+def _qc_stats(ind, met):
+    qcs = qc_columns(ind, met)
+    df = read_file(ind, met, usecols=['Name'] + qcs)
+    mean, rsd = _row_rsd(df[qcs].to_numpy(dtype='float64'))
+    return df['Name'].to_numpy(dtype=object), mean, rsd
+
+
+def both_dropped(ind):
+    # per mode, the names given up to the other mode; decided once from
+    # the QC columns so every projection of met='both' drops the same rows
+    stamps = [
+        _stamp(f'Result-{ind}/1.MetQuant/meta_intensity_{met}.xls')
+        for met in MODES
+    ]
+    key = (ind, _both_rule)
+    hit = _both_drops.get(key)
+    if hit is not None and hit[0] == stamps:
+        return hit[1]
+
+    drops = {met: pd.Index([], dtype=object) for met in MODES}
+    if _both_rule is not None:
+        stats = _read_modes(_qc_stats, ind)
+        names = np.concatenate([name for name, _, _ in stats])
+        mode = np.repeat(np.arange(len(MODES)), [len(s[0]) for s in stats])
+        if _both_rule in MODES:
+            score = (mode != MODES.index(_both_rule)).astype('float64')
+        elif _both_rule == 'rsd':
+            score = np.concatenate([rsd for _, _, rsd in stats])
+        else:
+            score = -np.concatenate([mean for _, mean, _ in stats])
+        score = np.where(np.isnan(score), np.inf, score)
+
+        # best row first, neg on ties; a name's first row picks its mode
+        order = np.lexsort((mode, score))
+        first = ~pd.Index(names[order]).duplicated()
+        winner = pd.Series(mode[order][first], index=names[order][first])
+        shared = pd.Index(stats[0][0]).intersection(pd.Index(stats[1][0]))
+        won = winner.reindex(shared).to_numpy()
+        drops = {met: shared[won != i] for i, met in enumerate(MODES)}
+
+    _both_drops[key] = (stamps, drops)
+    return drops
+
+
+def _both_column(col, met):
+    return re.sub(f'^{met}_', 'both_', col) if isinstance(col, str) else col
+
+
+def _read_mode(ind, met, func, usecols, kwargs):
+    if usecols is not None:
+        # both_ columns are read as the mode's own, when it has them
+        header = set(read_header(ind, met))
+        cols = [re.sub('^both_', f'{met}_', col) for col in usecols]
+        kwargs = dict(kwargs, usecols=[col for col in cols if col in header])
+    return func(ind, met, **kwargs)
+
+
+def read_both(reader, ind, usecols=None, **kwargs):
+    # one table for met='both': value columns renamed from neg_/pos_ to
+    # both_, a mode column, and shared metabolites resolved by the rule
+    # set with set_both_rule
+    drops = both_dropped(ind)
+    read_cols = None
+    if usecols is not None:
+        read_cols = list(usecols)
+        if 'Name' not in read_cols:
+            read_cols = ['Name'] + read_cols
+
+    frames = _read_modes(_read_mode,
+                         ind,
+                         func=reader,
+                         usecols=read_cols,
+                         kwargs=kwargs)
+    parts = []
+    for met, df in zip(MODES, frames):
+        names = df['Name'] if 'Name' in df.columns else df.index
+        df = df[~pd.Index(names).isin(drops[met])]
+        df = df.rename(columns=lambda col: _both_column(col, met))
+        if usecols is None:
+            df = df.assign(mode=met)
+        parts.append(df)
+
+    both = pd.concat(parts)
+    if usecols is not None:
+        cols = list(usecols)
+        if 'Name' in cols and 'mid' in both.columns:
+            cols.append('mid')
+        both = both.reindex(columns=cols)
+    return both
+
+
+def read_anno(ind: int, met='neg', unicode=True):
+    if hasattr(ind, 'table'):
+        return ind.table(read_anno, met, unicode=unicode)
+    if met == 'both':
+        return read_both(read_anno, ind, unicode=unicode)
     path = f'Result-{ind}/2.MetAnnotation/KEGG/meta_{met}_kegg_anno.xls'
-    df = pd.read_table(path, sep='\t', encoding_errors='ignore', index_col=0)
-    return df.set_index('Name')
+    return _cached(ind,
+                   met,
+                   path,
+                   lambda path: _read_unicode(path, unicode).set_index('Name'),
+                   variant=unicode)
 
 
-def read_volcano(ind: int, met='neg'):
+def read_volcano(ind: int, met='neg', unicode=True):
+    if hasattr(ind, 'table'):
+        return ind.table(read_volcano, met, unicode=unicode)
+    if met == 'both':
+        volc_df = read_both(read_volcano, ind, unicode=unicode)
+        return volc_df.sort_values(by='FC', ascending=False, kind='stable')
     path = f'Result-{ind}/volcano-{met}.csv'
-    volc_df = pd.read_csv(path, index_col=0)
-    volc_df.index.name = 'Name'
-    return volc_df.sort_values(by='FC', ascending=False)
 
+    def parse(path):
+        volc_df = _read_unicode(path, unicode, sep=',')
+        volc_df.index.name = 'Name'
+        return volc_df.sort_values(by='FC', ascending=False)
 
-def read_oplsda(ind, met='neg'):
+    return _cached(ind, met, path, parse, variant=unicode)
+
+
+def read_oplsda(ind, met='neg', unicode=True):
+    if hasattr(ind, 'table'):
+        return ind.table(read_oplsda, met, unicode=unicode)
+    if met == 'both':
+        return read_both(read_oplsda, ind,
+                         unicode=unicode).reset_index(drop=True)
     path = f'Result-{ind}/oplsda_vip-{met}.csv'
-    df = pd.read_csv(path, index_col=0)
-    df.index.name = 'Name'
-    return df.reset_index()
+
+    def parse(path):
+        df = _read_unicode(path, unicode, sep=',')
+        df.index.name = 'Name'
+        return df.reset_index()
+
+    return _cached(ind, met, path, parse, variant=unicode)
 
 
 def read_oplsda_model(ind, met='neg'):
+    if hasattr(ind, 'table'):
+        return ind.table(read_oplsda_model, met)
     path = f'Result-{ind}/oplsda_model-{met}.csv'
+    record_read(path, os.path.getsize(path))
     df = pd.read_csv(path, index_col=0)
     df.index.name = 'Name'
     return df
 
 
-def read_annol(ind, met='neg'):
+def read_annol(ind, met='neg', unicode=True):
+    if hasattr(ind, 'table'):
+        return ind.table(read_annol, met, unicode=unicode)
+    if met == 'both':
+        return read_both(read_annol, ind, unicode=unicode)
     path = f'Result-{ind}/2.MetAnnotation/Lipidmaps/meta_{met}_lipidmaps_anno.xls'
-    return pd.read_table(path, sep='\t', encoding_errors='ignore', index_col=0)
+    return _cached(ind,
+                   met,
+                   path,
+                   lambda path: _read_unicode(path, unicode),
+                   variant=unicode)
+
+
+instrument(__name__)
@@ -0,0 +1 @@
+from mbstudy.mbstudy import Project, Study
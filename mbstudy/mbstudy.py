@@ -0,0 +1,117 @@
+import sys
+
+import numpy as np
+import pandas as pd
+
+from mbbatch import run_batch
+from mbread import add_name_ids, read_file
+
+
+class Project:
+
+    __slots__ = ('ind', 'name', '_intensity', '_views')
+
+    def __init__(self, ind, name):
+        self.ind = ind
+        self.name = name
+        self._intensity = {}
+        self._views = {}
+
+    def __int__(self):
+        return self.ind
+
+    def __index__(self):
+        return self.ind
+
+    def __format__(self, spec):
+        return format(self.ind, spec)
+
+    def __repr__(self):
+        return f'Project({self.ind}, {self.name!r})'
+
+    def intensity(self, met='neg', unicode=True):
+
+        key = (met, unicode)
+        if key not in self._intensity:
+            df = read_file(self.ind, met, unicode=unicode)
+            numeric = df.select_dtypes('floating').columns
+            text = df.drop(columns=numeric.append(pd.Index(['mid'])),
+                           errors='ignore')
+            if 'Name' in text:
+                text['Name'] = [
+                    sys.intern(name) if isinstance(name, str) else name
+                    for name in text['Name']
+                ]
+            self._intensity[key] = {
+                'columns': df.columns.drop('mid', errors='ignore'),
+                'numeric': numeric,
+                'values': np.ascontiguousarray(df[numeric], dtype='float32'),
+                'text': text,
+            }
+        return self._intensity[key]
+
+    def header(self, met='neg'):
+        return self.intensity(met)['columns'].tolist()
+
+    def read_file(self, met='neg', unicode=True, usecols=None, compact=False):
+
+        store = self.intensity(met, unicode)
+        cols = store['columns'] if usecols is None else pd.Index(usecols)
+
+        numeric = cols[cols.isin(store['numeric'])]
+        values = store['values'][:, store['numeric'].get_indexer(numeric)]
+        if not compact:
+            values = values.astype('float64')
+        df = pd.DataFrame(values,
+                          index=store['text'].index,
+                          columns=numeric,
+                          copy=False)
+        for loc, col in enumerate(cols):
+            if col not in store['numeric']:
+                df.insert(loc, col, store['text'][col].array)
+        return add_name_ids(df)
+
+    def table(self, reader, met='neg', **kwargs):
+
+        key = (reader.__name__, met, tuple(sorted(kwargs.items())))
+        if key not in self._views:
+            # ids are added to each copy handed out, like _cached does, so
+            # a view never carries ids from an earlier dictionary
+            df = reader(self.ind, met, **kwargs)
+            self._views[key] = df.drop(columns='mid', errors='ignore')
+        return add_name_ids(self._views[key].copy())
+
+    def clear(self):
+        self._intensity.clear()
+        self._views.clear()
+
+
+class Study:
+
+    __slots__ = ('obj_names', 'projects')
+
+    def __init__(self, obj_names):
+        self.obj_names = list(obj_names)
+        self.projects = [
+            Project(ind, obj)
+            for ind, obj in enumerate(self.obj_names, start=1)
+        ]
+
+    def __getitem__(self, ind):
+        return self.projects[int(ind) - 1]
+
+    def __iter__(self):
+        return iter(self.projects)
+
+    def __len__(self):
+        return len(self.projects)
+
+    def __repr__(self):
+        return f'Study({self.obj_names!r})'
+
+    def load(self, mets=('neg', 'pos'), workers=None):
+
+        # threads, since the loaded arrays have to land on these objects
+        tasks = [(project, met) for met in mets for project in self.projects]
+        run_batch(Project.intensity, tasks, workers=workers, kind='thread')
+        return self
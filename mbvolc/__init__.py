@@ -1,4 +1,9 @@
-from mbvolc.mbvolc import (add_volc_distance, check_volc_kegg,
-                           check_volc_kegg2, count_vol, list_volc_kegg,
-                           list_volc_sig, list_volc_sig2, plot_volcano,
-                           sec_vol, tabularize_volc_kegg)
+from mbvolc.mbvolc import (CONTRAST_STATS, add_volc_distance, adjust_bh,
+                           calc_contrasts, calc_volcano, calc_volcanos,
+                           check_volc_kegg, check_volc_kegg2, clear_kegg_cache,
+                           contrast_stats, count_vol, enrich_volc_kegg,
+                           kegg_index, kegg_members, kegg_mids, kegg_pathways,
+                           kegg_rows, list_volc_kegg, list_volc_sig,
+                           list_volc_sig2, load_volc, load_volcs, plot_volcano,
+                           sec_vol, summarize_volc, sweep_volc,
+                           tabularize_volc_kegg, volc_codes, volc_sig)
@@ -1,8 +1,15 @@
-import matplotlib.pyplot as plt
+import glob
+import os
+import re
+
 import numpy as np
 import pandas as pd
 
-from mbread import read_anno, read_volcano
+from mbbatch import run_batch
+from mbprof import instrument, record_read
+from mbread import (MODES, both_dropped, design_columns, design_groups,
+                    name_ids, on_clear_cache, read_anno, read_design,
+                    read_file, read_volcano, resolve_contrasts, unicode_digest)
 
 
 def add_volc_distance(volc_df, fcthr=2, pthr=0.05):
@@ -22,83 +29,440 @@ def add_volc_distance(volc_df, fcthr=2, pthr=0.05):
     return volc_df.sort_values(by='distance', ascending=False)
 
 
-def count_vol(obj_names, fcthr=2, pthr=0.05, met='neg'):
-
-    nms = pd.DataFrame()
+def load_volc(ind, met='neg'):
 
-    for ind, obj in enumerate(obj_names, start=1):
-        volc_df = read_volcano(ind, met)
-        vol = add_volc_distance(volc_df, fcthr=fcthr,
-                                pthr=pthr).query('raw.pval < pthr')
-        volc_up = vol.query('FC>4').shape[0]
-        volc_down = vol.query('FC<0.25').shape[0]
-        nms.index = ['up regulated', 'down regulated', 'total']
-        nms[obj] = [volc_up, volc_down, volc_up + volc_down]
+    volc_df = read_volcano(ind, met)
+    volc_df['log2(FC)'] = np.log2(volc_df['FC'])
+    volc_df['-log10(p)'] = -np.log10(volc_df['raw.pval'])
+    return volc_df
 
-    return nms
 
+def load_volcs(obj_names, met='neg', workers=None):
 
-def list_volc_sig(obj_names, fcthr=2, pthr=0.05, direc='up', met='neg'):
+    tasks = [(ind, met) for ind, _ in enumerate(obj_names, start=1)]
+    return run_batch(load_volc, tasks, workers=workers)
 
-    checks = []
 
-    for ind, _ in enumerate(obj_names, start=1):
-        volc_df = read_volcano(ind, met)
-        vf = add_volc_distance(volc_df, fcthr=fcthr, pthr=pthr)
-        vf = vf[vf['raw.pval'] < pthr]
+def volcano_stats(df, ref, case, test='welch'):
+    from scipy.stats import mannwhitneyu, ttest_ind
 
-        if direc == 'up':
-            vf = vf[vf['FC'] > fcthr**2]
-        elif direc == 'down':
-            vf = vf[vf['FC'] < 1 / fcthr**2]
+    a = df[list(ref)].to_numpy(dtype='float64')
+    b = df[list(case)].to_numpy(dtype='float64')
 
-        vf = vf.reset_index()['Name']
-        checks.append(vf)
+    # every feature in one call: scipy's tests broadcast along axis=1
+    if test in ('welch', 'student'):
+        pval = ttest_ind(b, a, axis=1, equal_var=test == 'student').pvalue
+    elif test == 'mannwhitney':
+        pval = mannwhitneyu(b, a, axis=1).pvalue
+    else:
+        raise ValueError(f'unknown test: {test}')
 
-    volc_list = pd.concat(checks, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fc = b.mean(axis=1) / a.mean(axis=1)
+    volc_df = pd.DataFrame({'FC': fc, 'raw.pval': pval}, index=df.index)
+    volc_df['p.adj'] = adjust_bh(np.nan_to_num(pval, nan=1))
+    volc_df['log2(FC)'] = np.log2(volc_df['FC'])
+    volc_df['-log10(p)'] = -np.log10(volc_df['raw.pval'])
+    return volc_df.sort_values(by='FC', ascending=False)
+
+
+def _contrast_columns(design, side):
+    # a group name of the design, or an explicit list of columns
+    if isinstance(side, str):
+        return design_columns(design, [side])
+    return list(side)
+
+
+def calc_volcanos(ind, contrasts, met='neg', test='welch', design=None):
+    # contrasts map a name to (ref, case), each a list of columns or a
+    # group of the sample design
+    if any(
+            isinstance(side, str) for pair in contrasts.values()
+            for side in pair):
+        design = read_design(ind, met, design)
+        contrasts = {
+            name: tuple(_contrast_columns(design, side) for side in pair)
+            for name, pair in contrasts.items()
+        }
+
+    cols = list(
+        dict.fromkeys(c for ref, case in contrasts.values()
+                      for c in list(ref) + list(case)))
+    df = read_file(ind, met, usecols=['Name'] + cols).set_index('Name')
+
+    return {
+        name: volcano_stats(df, ref, case, test=test)
+        for name, (ref, case) in contrasts.items()
+    }
+
+
+def calc_volcano(ind, obj, met='neg', test='welch', n=None, design=None):
+
+    if n is None:
+        # the ref and case groups of the design, of any size
+        design = read_design(ind, met, design)
+        contrast = design_groups(design, obj)
+    else:
+        contrast = ([f'{met}_{obj}r{i}' for i in range(1, n + 1)],
+                    [f'{met}_{obj}{i}' for i in range(1, n + 1)])
+    return calc_volcanos(ind, {obj: contrast},
+                         met=met,
+                         test=test,
+                         design=design)[obj]
+
+
+CONTRAST_STATS = ('ref_mean', 'case_mean', 'FC', 'log2(FC)', 'paired_diff',
+                  'n_pairs')
+
+
+def _group_sums(values, index, n_groups):
+    # NaN-aware sums and counts of column groups as two matrix products
+    member = np.zeros((values.shape[1], n_groups))
+    member[np.arange(values.shape[1]), index] = 1
+    valid = ~np.isnan(values)
+    return np.where(valid, values, 0) @ member, valid @ member
+
+
+def contrast_stats(values, contrasts):
+    # values is features x contrasts.columns; every group mean is taken
+    # once, however many contrasts share the group, and all paired
+    # differences come from a single gather
+    sums, counts = _group_sums(values, contrasts.group_of,
+                               len(contrasts.groups))
+    diffs = values[:, contrasts.pair_case] - values[:, contrasts.pair_ref]
+    dsums, dcounts = _group_sums(diffs, contrasts.pair_of,
+                                 len(contrasts.names))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums / counts
+        ref = means[:, contrasts.ref]
+        case = means[:, contrasts.case]
+        fc = case / ref
+        return {
+            'ref_mean': ref,
+            'case_mean': case,
+            'FC': fc,
+            'log2(FC)': np.log2(fc),
+            'paired_diff': dsums / dcounts,
+            'n_pairs': dcounts
+        }
+
+
+def calc_contrasts(ind, contrasts=None, met='neg', design=None):
+    # every contrast of a study from one read of the sample columns; the
+    # columns are (contrast, statistic)
+    contrasts = resolve_contrasts(read_design(ind, met, design), contrasts)
+    df = read_file(ind, met,
+                   usecols=['Name'] + contrasts.columns).set_index('Name')
+    stats = contrast_stats(df[contrasts.columns].to_numpy(dtype='float64'),
+                           contrasts)
+
+    values = np.stack([stats[stat] for stat in CONTRAST_STATS], axis=2)
+    columns = pd.MultiIndex.from_product([contrasts.names, CONTRAST_STATS])
+    return pd.DataFrame(values.reshape(len(df), -1),
+                        index=df.index,
+                        columns=columns)
+
+
+def volc_sig(volc_df, fcthr=2, pthr=0.05):
+
+    fc = volc_df['FC'].to_numpy()
+    lfc = volc_df['log2(FC)'].to_numpy()
+    lp = volc_df['-log10(p)'].to_numpy()
+
+    # same ordering as add_volc_distance, from the precomputed columns
+    dist = np.where(fc >= fcthr, np.hypot(lfc - fcthr, lp - pthr),
+                    np.hypot(lfc + fcthr, lp - pthr))
+    order = np.argsort(-dist, kind='stable')
+
+    sig = volc_df['raw.pval'].to_numpy()[order] < pthr
+    up = sig & (fc[order] > fcthr**2)
+    down = sig & (fc[order] < 1 / fcthr**2)
+    names = volc_df.index.to_numpy()[order]
+
+    return {
+        'up': names[up],
+        'down': names[down],
+        'total': names[up | down],
+        'all': names[sig]
+    }
+
+
+def _volc_frame(lists, obj_names):
+
+    volc_list = pd.concat([pd.Series(names, name='Name') for names in lists],
+                          axis=1)
     volc_list.columns = obj_names
-
     return volc_list
 
 
-def list_volc_sig2(obj_names, fcthr=2, pthr=0.05, met='neg'):
+def summarize_volc(obj_names,
+                   fcthr=2,
+                   pthr=0.05,
+                   met='neg',
+                   volcs=None,
+                   workers=None):
+
+    if volcs is None:
+        volcs = load_volcs(obj_names, met, workers=workers)
+    sigs = [volc_sig(volc_df, fcthr=fcthr, pthr=pthr) for volc_df in volcs]
+
+    summary = {
+        direc: _volc_frame([sig[direc] for sig in sigs], obj_names)
+        for direc in ('up', 'down', 'total')
+    }
+    summary['counts'] = pd.DataFrame(
+        [[len(sig[direc]) for sig in sigs]
+         for direc in ('up', 'down', 'total')],
+        index=['up regulated', 'down regulated', 'total'],
+        columns=obj_names)
+    return summary
+
+
+def sweep_volc(obj_names,
+               fcthrs=(2, ),
+               pthrs=(0.05, ),
+               met='neg',
+               volcs=None,
+               workers=None):
+
+    if volcs is None:
+        volcs = load_volcs(obj_names, met, workers=workers)
+
+    rows = []
+
+    for obj, volc_df in zip(obj_names, volcs):
+        fc = volc_df['FC'].to_numpy()
+        pval = volc_df['raw.pval'].to_numpy()
+        for fcthr in fcthrs:
+            up_fc = fc > fcthr**2
+            down_fc = fc < 1 / fcthr**2
+            for pthr in pthrs:
+                sig = pval < pthr
+                up = int((sig & up_fc).sum())
+                down = int((sig & down_fc).sum())
+                rows.append([obj, fcthr, pthr, up, down, up + down])
+
+    return pd.DataFrame(
+        rows, columns=['project', 'fcthr', 'pthr', 'up', 'down', 'total'])
+
+
+def count_vol(obj_names,
+              fcthr=2,
+              pthr=0.05,
+              met='neg',
+              volcs=None,
+              workers=None):
+
+    return summarize_volc(obj_names,
+                          fcthr=fcthr,
+                          pthr=pthr,
+                          met=met,
+                          volcs=volcs,
+                          workers=workers)['counts']
+
+
+def list_volc_sig(obj_names,
+                  fcthr=2,
+                  pthr=0.05,
+                  direc='up',
+                  met='neg',
+                  volcs=None,
+                  workers=None):
+
+    if volcs is None:
+        volcs = load_volcs(obj_names, met, workers=workers)
+    if direc not in ('up', 'down'):
+        direc = 'all'
+
+    checks = [
+        volc_sig(volc_df, fcthr=fcthr, pthr=pthr)[direc] for volc_df in volcs
+    ]
+    return _volc_frame(checks, obj_names)
+
+
+def list_volc_sig2(obj_names,
+                   fcthr=2,
+                   pthr=0.05,
+                   met='neg',
+                   volcs=None,
+                   workers=None):
+
+    summary = summarize_volc(obj_names,
+                             fcthr=fcthr,
+                             pthr=pthr,
+                             met=met,
+                             volcs=volcs,
+                             workers=workers)
+    return [summary['up'], summary['down']]
+
+
+KEGG_NOISE = ('Metabolic pathways',
+              'Microbial metabolism in diverse environments',
+              'Biosynthesis of secondary metabolites')
+
+
+def _csr(groups, n):
+    indptr = np.zeros(n + 1, dtype='int64')
+    indptr[1:] = np.cumsum([len(g) for g in groups])
+    indices = np.fromiter((i for g in groups for i in g), dtype='int32')
+    return indptr, indices
+
+
+def _build_kegg_index(anno_df):
+
+    maps = anno_df['Kegg_map'].dropna().astype(str)
+    names = pd.unique(maps.index.to_numpy())
+    rows = pd.Index(names).get_indexer(maps.index)
+
+    pathway_ids = {}
+    met_paths = [{} for _ in names]
+    for row, kegg_map in zip(rows, maps):
+        for label in kegg_map.split(';'):
+            label = re.sub(r'map\d+', '', label).strip()
+            if label and label != 'nan' and label not in KEGG_NOISE:
+                pid = pathway_ids.setdefault(label, len(pathway_ids))
+                met_paths[row].setdefault(pid)
+
+    met_paths = [list(paths) for paths in met_paths]
+    path_mets = [[] for _ in pathway_ids]
+    for row, paths in enumerate(met_paths):
+        for pid in paths:
+            path_mets[pid].append(row)
+
+    met_ptr, met_path = _csr(met_paths, len(names))
+    path_ptr, path_met = _csr(path_mets, len(pathway_ids))
+    return {
+        'names': np.asarray(names, dtype=str),
+        'pathways': np.asarray(list(pathway_ids), dtype=str),
+        'met_ptr': met_ptr,
+        'met_path': met_path,
+        'path_ptr': path_ptr,
+        'path_met': path_met,
+    }
+
+
+_kegg_indexes = {}
+
+
+def _kegg_stamp(kegg, mets):
+
+    stamps = []
+    for met in mets:
+        st = os.stat(f'{kegg}/meta_{met}_kegg_anno.xls')
+        stamps += [st.st_mtime_ns, st.st_size]
+    # the index holds unicodified names, so the mapping is part of it
+    stamps.append(unicode_digest())
+    return np.array(stamps, dtype='int64')
+
+
+def clear_kegg_cache(persisted=False):
+    # the in-memory indexes and, with persisted, the .npz files beside the
+    # KEGG annotations of every Result-N in the working directory
+    _kegg_indexes.clear()
+    if persisted:
+        for path in glob.glob(
+                'Result-*/2.MetAnnotation/KEGG/meta_*_kegg_index.npz'):
+            os.remove(path)
+
+
+on_clear_cache(clear_kegg_cache)
+
 
-    volc_list = list_volc_sig(obj_names,
-                              fcthr=fcthr,
-                              pthr=pthr,
-                              direc='up',
-                              met=met)
-    volc_list_dn = list_volc_sig(obj_names,
-                                 fcthr=fcthr,
-                                 pthr=pthr,
-                                 direc='down',
-                                 met=met)
-    return [volc_list, volc_list_dn]
+def kegg_index(ind, met='neg'):
+
+    kegg = f'Result-{ind}/2.MetAnnotation/KEGG'
+    path = f'{kegg}/meta_{met}_kegg_anno.xls'
+    index_path = f'{kegg}/meta_{met}_kegg_index.npz'
+    stamp = _kegg_stamp(kegg, MODES if met == 'both' else (met, ))
+    drops = both_dropped(ind) if met == 'both' else None
 
+    index = _kegg_indexes.get(path)
+    if (index is not None and np.array_equal(index['stamp'], stamp)
+            and index['drops'] is drops):
+        return index
+
+    index = None
+    if drops is None and os.path.exists(index_path):
+        record_read(index_path, os.path.getsize(index_path), 'npz')
+        with np.load(index_path) as npz:
+            if np.array_equal(npz['stamp'], stamp):
+                index = dict(npz)
+    if index is None:
+        index = _build_kegg_index(read_anno(ind, met))
+        index['stamp'] = stamp
+        # the met='both' index also depends on the intensity files and the
+        # rule behind both_dropped, so it is only kept in memory
+        if drops is None:
+            np.savez(index_path, **index)
 
-def check_volc_kegg(ind, volc_list, obj_names, reduced=True, met='neg'):
+    index['drops'] = drops
+    index['lookup'] = pd.Index(index['names'])
+    _kegg_indexes[path] = index
+    return index
 
-    anno_df = read_anno(ind, met)
-    ch = volc_list[[obj_names[ind - 1]]]
-    ch.columns.values[0] = 'Name'
-    ch.set_index('Name', inplace=True)
 
-    res = ch.join(anno_df, how='inner')
-    res = res[res['Kegg_map'].str.contains("nan") == False].replace('map\d+',
-                                                                    '',
-                                                                    regex=True)
+def kegg_mids(index):
+    # index rows by metabolite id; rebuilt when another dictionary is active
+    ids = name_ids()
+    if index.get('ids') is not ids:
+        mids = ids.encode(index['names'])
+        pos = np.full(len(ids), -1, dtype='int64')
+        pos[mids] = np.arange(len(mids))
+        index['ids'], index['mids'], index['pos'] = ids, mids, pos
+    return index['mids']
+
+
+def kegg_rows(index, names):
+
+    names = np.asarray(names)
+    if names.dtype.kind not in 'iu':
+        names = name_ids().encode(names)
+    kegg_mids(index)
+    pos = index['pos']
+    inside = (names >= 0) & (names < len(pos))
+    rows = pos[names[inside]]
+    return rows[rows >= 0]
 
-    if reduced:
-        res = res['Kegg_map'].str.replace(
-            'Metabolic pathways;',
-            '').str.replace('Metabolic pathways', '').str.replace(
-                'Microbial metabolism',
-                '').str.replace('in diverse environments', '').str.replace(
-                    'Biosynthesis of secondary metabolites',
-                    '').str.replace('     ;', '').str.replace('   ;',
-                                                              '').str.strip()
 
-    return pd.DataFrame(res)
+def kegg_pathways(index, rows):
+
+    ptr = index['met_ptr']
+    return [
+        index['pathways'][index['met_path'][ptr[row]:ptr[row + 1]]]
+        for row in rows
+    ]
+
+
+def kegg_members(index, pathway):
+
+    pid = np.flatnonzero(index['pathways'] == pathway)
+    if not len(pid):
+        return index['names'][:0]
+    ptr = index['path_ptr']
+    return index['names'][index['path_met'][ptr[pid[0]]:ptr[pid[0] + 1]]]
+
+
+def check_volc_kegg(ind, volc_list, obj_names, reduced=True, met='neg'):
+
+    names = volc_list[obj_names[int(ind) - 1]].dropna()
+
+    if reduced:
+        index = kegg_index(ind, met)
+        rows = kegg_rows(index, names)
+        res = pd.Series(
+            ['; '.join(paths) for paths in kegg_pathways(index, rows)],
+            index=pd.Index(index['names'][rows], name='Name'),
+            name='Kegg_map',
+            dtype=object)
+        return pd.DataFrame(res)
+
+    # the ids are a join key, not part of the annotation handed back
+    anno_df = read_anno(ind, met).drop(columns='mid', errors='ignore')
+    ch = pd.DataFrame(index=pd.Index(names, name='Name'))
+    res = ch.join(anno_df, how='inner')
+    res = res[res['Kegg_map'].notna()].replace(r'map\d+', '', regex=True)
+    return res
 
 
 def check_volc_kegg2(ind,
@@ -125,35 +489,100 @@ def check_volc_kegg2(ind,
     return [kegg_list, kegg_list_dn]
 
 
-def list_volc_kegg(volc_list, obj_names, reduced=True, met='neg'):
+def adjust_bh(pvals):
 
-    res_names = pd.DataFrame()
+    pvals = np.asarray(pvals, dtype='float64')
+    m = len(pvals)
+    if not m:
+        return pvals
+    order = np.argsort(pvals)
+    ranked = pvals[order] * m / np.arange(1, m + 1)
+    qvals = np.empty(m)
+    qvals[order] = np.minimum.accumulate(ranked[::-1])[::-1].clip(max=1)
+    return qvals
 
-    for ind, _ in enumerate(obj_names, start=1):
-        anno_df = read_anno(ind, met)
-        resup_s = check_volc_kegg(ind, volc_list, obj_names, reduced,
-                                  met).reset_index()['Name']
-        res_names = pd.concat([res_names, resup_s], axis=1)
 
+def enrich_volc_kegg(obj_names,
+                     fcthr=2,
+                     pthr=0.05,
+                     met='neg',
+                     direcs=('up', 'down'),
+                     volcs=None,
+                     workers=None):
+    from scipy.stats import hypergeom
+
+    if volcs is None:
+        volcs = load_volcs(obj_names, met, workers=workers)
+
+    tables = []
+
+    for ind, (obj, volc_df) in enumerate(zip(obj_names, volcs), start=1):
+        index = kegg_index(ind, met)
+        sizes = np.diff(index['path_ptr'])
+        # the universe is every metabolite mapped to at least one pathway
+        mapped = np.diff(index['met_ptr']) > 0
+        owner = np.repeat(np.arange(len(mapped)), np.diff(index['met_ptr']))
+        sig = volc_sig(volc_df, fcthr=fcthr, pthr=pthr)
+
+        for direc in direcs:
+            rows = kegg_rows(index, sig[direc])
+            rows = rows[mapped[rows]]
+            hit_paths = index['met_path'][np.isin(owner, rows)]
+            hits = np.bincount(hit_paths, minlength=len(sizes))
+
+            table = pd.DataFrame({'pathway': index['pathways'], 'hits': hits})
+            table.insert(0, 'project', obj)
+            table.insert(1, 'direction', direc)
+            table['size'] = sizes
+            table['sig'] = len(rows)
+            table['universe'] = int(mapped.sum())
+            tables.append(table)
+
+    enrich = pd.concat(tables, ignore_index=True)
+    # one vectorized survival-function call over every pathway, project
+    # and direction at once; BH is then applied per project and direction
+    enrich['pval'] = hypergeom.sf(enrich['hits'] - 1, enrich['universe'],
+                                  enrich['size'], enrich['sig'])
+    enrich['qval'] = enrich.groupby(['project', 'direction'],
+                                    sort=False)['pval'].transform(adjust_bh)
+    # keep the project and direction order, most enriched pathways first
+    group = np.repeat(np.arange(len(tables)), [len(t) for t in tables])
+    order = np.lexsort((enrich['pval'].to_numpy(), group))
+    return enrich.iloc[order].reset_index(drop=True)
+
+
+def list_volc_kegg(volc_list,
+                   obj_names,
+                   reduced=True,
+                   met='neg',
+                   workers=None):
+
+    tasks = [(ind, volc_list, obj_names, reduced, met)
+             for ind, _ in enumerate(obj_names, start=1)]
+    res = run_batch(check_volc_kegg, tasks, workers=workers)
+
+    res_names = pd.concat([r.reset_index()['Name'] for r in res], axis=1)
     res_names.columns = obj_names
     return res_names
 
 
-def tabularize_volc_kegg(volc_list, obj_names, reduced=True, met='neg'):
+def tabularize_volc_kegg(volc_list,
+                         obj_names,
+                         reduced=True,
+                         met='neg',
+                         workers=None):
 
-    res_table = pd.DataFrame()
+    tasks = [(ind, volc_list, obj_names, reduced, met)
+             for ind, _ in enumerate(obj_names, start=1)]
+    res = run_batch(check_volc_kegg, tasks, workers=workers)
 
-    for ind, obj in enumerate(obj_names, start=1):
-        nnn = pd.DataFrame({
-            'Name': [obj_names[ind - 1]],
-            'Kegg_map': '-' * 10
-        })
-        res_table = res_table.append(nnn)
-        ress = check_volc_kegg(ind, volc_list, obj_names, reduced,
-                               met).reset_index()
-        res_table = res_table.append(ress)
+    res_table = []
 
-    return res_table.dropna()
+    for obj, ress in zip(obj_names, res):
+        nnn = pd.DataFrame({'Name': [obj], 'Kegg_map': '-' * 10})
+        res_table.extend([nnn, ress.reset_index()])
+
+    return pd.concat(res_table).dropna()
 
 
 def sec_vol(volc_df, fcthr=2, pthr=0.05):
@@ -169,7 +598,128 @@ def sec_vol(volc_df, fcthr=2, pthr=0.05):
     return [v1, v2, v3, v4]
 
 
-def plot_volcano(ax, v, title, fcthr=2, pthr=0.05, n_labeled=0):
+VOLC_COLORS = np.array(['grey', 'red', 'green'])
+
+
+def volc_codes(volc_df, fcthr=2, pthr=0.05):
+    # one code per point, same split as sec_vol: 0 other, 1 up, 2 down
+    lfc = np.log2(volc_df['FC'].to_numpy(dtype='float64'))
+    sig = volc_df['raw.pval'].to_numpy() < pthr
+    codes = np.zeros(len(lfc), dtype='int8')
+    codes[sig & (lfc > fcthr)] = 1
+    codes[sig & (lfc < -fcthr)] = 2
+    return codes
+
+
+def _place_labels(ax, x, y, fontsize, lengths):
+    # greedy placement in display space: each label takes the first of a
+    # few offsets around its point whose box overlaps no placed label;
+    # labels with no free slot are dropped
+    ax.autoscale_view()
+    px = ax.transData.transform(np.column_stack([x, y]))
+    scale = fontsize * ax.figure.dpi / 72
+    # text extent plus the rounded bbox padding
+    widths = (lengths * 0.6 + 0.6) * scale
+    height = 1.8 * scale
+    ring = np.array([(0, 1), (0, -1), (1, 0), (-1, 0), (1, 1), (-1, 1),
+                     (1, -1), (-1, -1)]) * [[0.6, 0.8]]
+    offsets = np.vstack([ring, 2 * ring, 3 * ring])
+
+    boxes = np.empty((0, 4))
+    placed = np.full((len(x), 2), np.nan)
+    for i in range(len(x)):
+        w = widths[i]
+        # candidate lower-left corners, one per offset
+        llx = px[i, 0] - w / 2 + offsets[:, 0] * w
+        lly = px[i, 1] - height / 2 + offsets[:, 1] * height
+        free = ~((llx[:, None] < boxes[:, 2]) &
+                 (llx[:, None] + w > boxes[:, 0])
+                 & (lly[:, None] < boxes[:, 3])
+                 & (lly[:, None] + height > boxes[:, 1])).any(axis=1)
+        if free.any():
+            k = free.argmax()
+            box = [llx[k], lly[k], llx[k] + w, lly[k] + height]
+            boxes = np.vstack([boxes, box])
+            placed[i] = [llx[k] + w / 2, lly[k] + height / 2]
+
+    keep = ~np.isnan(placed[:, 0])
+    data = ax.transData.inverted().transform(placed[keep])
+    return keep, data
+
+
+def plot_volcano(ax,
+                 v,
+                 title,
+                 fcthr=2,
+                 pthr=0.05,
+                 n_labeled=0,
+                 mode='scatter',
+                 gridsize=60,
+                 fontsize=8):
+
+    if mode == 'scatter':
+        return _plot_volcano_scatter(ax, v, title, fcthr, pthr, n_labeled)
+    if mode not in ('fast', 'density'):
+        raise ValueError(f'unknown mode: {mode}')
+
+    x = np.log2(v['FC'].to_numpy(dtype='float64'))
+    y = -np.log10(v['raw.pval'].to_numpy(dtype='float64'))
+    codes = volc_codes(v, fcthr=fcthr, pthr=pthr)
+
+    # one rasterized collection keeps large panels fast and PDFs small
+    if mode == 'density':
+        other = codes == 0
+        ax.hexbin(x[other],
+                  y[other],
+                  gridsize=gridsize,
+                  bins='log',
+                  cmap='Greys',
+                  mincnt=1,
+                  rasterized=True)
+        x, y, codes = x[~other], y[~other], codes[~other]
+        names = v.index.to_numpy()[~other]
+    else:
+        names = v.index.to_numpy()
+    ax.scatter(x, y, c=VOLC_COLORS[codes], s=8, linewidths=0, rasterized=True)
+
+    if n_labeled > 0:
+        # the n points furthest from the guides, per direction
+        dist = np.hypot(np.abs(x) - fcthr, y + np.log10(pthr))
+        top = []
+        for code in (1, 2):
+            idx = np.flatnonzero(codes == code)
+            n = min(n_labeled, len(idx))
+            top.append(idx[np.argsort(-dist[idx], kind='stable')[:n]])
+        top = np.concatenate(top)
+        texts = names[top].astype(str)
+        keep, pos = _place_labels(ax, x[top], y[top], fontsize,
+                                  np.char.str_len(texts))
+        for (tx, ty), text in zip(pos, texts[keep]):
+            ax.text(tx,
+                    ty,
+                    text,
+                    fontsize=fontsize,
+                    ha='center',
+                    va='center',
+                    bbox=dict(
+                        boxstyle="round",
+                        ec=(1., 0.5, 0.5),
+                        fc=(1., 0.9, 0.5),
+                    ))
+
+    _volcano_guides(ax, fcthr, pthr)
+    ax.set_title(title, fontsize='large')
+    return ax
+
+
+def _volcano_guides(ax, fcthr, pthr):
+
+    for x in (-fcthr, fcthr):
+        ax.axvline(x, color='black', linestyle='-.', linewidth=.5)
+    ax.axhline(-np.log10(pthr), color='black', linestyle='-.', linewidth=.5)
+
+
+def _plot_volcano_scatter(ax, v, title, fcthr=2, pthr=0.05, n_labeled=0):
 
     seced_vol = sec_vol(v, fcthr=fcthr, pthr=pthr)
     colors = ['red', 'green', 'grey', 'grey']
@@ -191,7 +741,9 @@ def plot_volcano(ax, v, title, fcthr=2, pthr=0.05, n_labeled=0):
                             fc=(1., 0.9, 0.5),
                         ))
 
-    ax.vlines([-2, 2], -1, 5, colors='black', linestyles='-.', linewidth=.5)
-    ax.hlines([0.05], -20, 20, colors='black', linestyles='-.', linewidth=.5)
+    _volcano_guides(ax, fcthr, pthr)
     ax.set_title(title, fontsize='large')
     return ax
+
+
+instrument(__name__)